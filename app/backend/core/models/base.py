@@ -1,13 +1,16 @@
 from pathlib import Path
 import re
 import tarfile
+import io
 import os
 import sys
 from collections import defaultdict
 import types
+import itertools
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '../submodules/ComfyUI'))
 
 import peft
+import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -52,7 +55,7 @@ def extract_clips(video, target_frames, video_clip_mode):
         raise NotImplementedError(f'video_clip_mode={video_clip_mode} is not recognized')
 
 
-def convert_crop_and_resize(pil_img, width_and_height):
+def convert_to_rgb(pil_img):
     if pil_img.mode not in ['RGB', 'RGBA'] and 'transparency' in pil_img.info:
         pil_img = pil_img.convert('RGBA')
 
@@ -60,18 +63,63 @@ def convert_crop_and_resize(pil_img, width_and_height):
     if pil_img.mode == 'RGBA':
         canvas = Image.new('RGBA', pil_img.size, (255, 255, 255))
         canvas.alpha_composite(pil_img)
-        pil_img = canvas.convert('RGB')
-    else:
-        pil_img = pil_img.convert('RGB')
+        return canvas.convert('RGB')
+    return pil_img.convert('RGB')
+
+
+def convert_crop_and_resize(pil_img, width_and_height):
+    return ImageOps.fit(convert_to_rgb(pil_img), width_and_height)
 
-    return ImageOps.fit(pil_img, width_and_height)
+
+def fit_crop_box(width, height, width_and_height):
+    # Same center crop as ImageOps.fit(), rounded to whole pixels.
+    output_ratio = width_and_height[0] / width_and_height[1]
+    if width / height >= output_ratio:
+        crop_width, crop_height = output_ratio * height, height
+    else:
+        crop_width, crop_height = width, width / output_ratio
+    left = round((width - crop_width) / 2)
+    top = round((height - crop_height) / 2)
+    return left, top, left + max(round(crop_width), 1), top + max(round(crop_height), 1)
+
+
+def crop_and_resize_frames(frames, width_and_height):
+    '''Batched equivalent of convert_crop_and_resize() followed by ToTensor and Normalize, for same-sized RGB uint8 frames
+    of shape (N, H, W, 3). Returns (N, 3, H, W) floats in [-1, 1]. Uses interpolate's uint8 kernels, which are several times
+    faster than PIL's resize. Matches the PIL path to within a few uint8 levels per pixel (mean absolute difference
+    typically below 0.5 levels), the differences coming from PIL's subpixel crop box.'''
+    frames = torch.from_numpy(np.ascontiguousarray(frames))
+    left, top, right, bottom = fit_crop_box(frames.shape[2], frames.shape[1], width_and_height)
+    # NHWC viewed as NCHW is channels_last, which lets interpolate use its vectorized uint8 kernels
+    x = frames[:, top:bottom, left:right].permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
+    width, height = width_and_height
+    if x.shape[-2:] != (height, width):
+        x = F.interpolate(x, size=(height, width), mode='bicubic', align_corners=False, antialias=True)
+    return x.float().div_(127.5).sub_(1)
 
 
 class PreprocessMediaFile:
-    def __init__(self, config, support_video=False, framerate=None, round_height=16, round_width=16, round_frames=4):
+    '''Loads an image or video file and crops and resizes it to its size bucket. resize_backend 'pil' resizes one PIL
+    image at a time. 'torch' crops and resizes batches of uint8 frames with F.interpolate, see crop_and_resize_frames(),
+    which is faster, most of all for videos with many frames. Its results differ from 'pil' by a few uint8 levels.
+
+    Models can pass a different resize_backend in get_preprocess_media_file_fn(), and the resize_backend config setting
+    overrides it. The backend isn't part of the latents cache keys, so changing it doesn't re-cache existing items. That's
+    why every model keeps 'pil' and users opt in to 'torch' (with --regenerate_cache for existing caches).'''
+
+    # Frames resized together by the torch resize backend.
+    RESIZE_BATCH_SIZE = 16
+
+    def __init__(self, config, support_video=False, framerate=None, round_height=16, round_width=16, round_frames=4, resize_backend='pil'):
         self.config = config
+        self.resize_backend = config.get('resize_backend', resize_backend)
+        if self.resize_backend not in ('pil', 'torch'):
+            raise ValueError(f'resize_backend must be pil or torch, got {self.resize_backend}')
         self.video_clip_mode = config.get('video_clip_mode', 'single_beginning')
         print(f'using video_clip_mode={self.video_clip_mode}')
+        # For single_middle, find the middle from the duration in the container metadata, so only the frames of the clip
+        # need to be decoded up to the end of the clip. The metadata can be slightly off, which shifts the clip a little.
+        self.fast_single_middle = config.get('fast_single_middle_decode', False)
         self.pil_to_tensor = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
         self.support_video = support_video
         self.framerate = framerate
@@ -87,28 +135,83 @@ class PreprocessMediaFile:
         for tar_f in self.tarfile_map.values():
             tar_f.close()
 
-    def __call__(self, spec, mask_filepath, size_bucket=None):
+    def _open(self, spec, data=None):
+        if data is not None:
+            return io.BytesIO(data)
+        if spec[0] is None:
+            return str(spec[1])
+        tar_filename = spec[0]
+        if tar_filename not in self.tarfile_map:
+            self.tarfile_map[tar_filename] = tarfile.TarFile(tar_filename)
+        return self.tarfile_map[tar_filename].extractfile(str(spec[1]))
+
+    def _estimate_num_frames(self, filepath_or_file, extension):
+        try:
+            duration = imageio.v3.immeta(filepath_or_file, extension=extension)['duration']
+        except Exception:
+            return None
+        finally:
+            if hasattr(filepath_or_file, 'seek'):
+                filepath_or_file.seek(0)
+        return int(self.framerate * duration)
+
+    def _resize_frames(self, frames, resize_wh, keep_start=0, keep_end=None, capacity=1):
+        # Streams frames into a buffer that grows as needed, so a video is only decoded once. Frames before keep_start
+        # are decoded but not resized, and decoding stops at keep_end.
+        width, height = resize_wh
+        resized_video = torch.empty((capacity, 3, height, width))
+        num_frames = 0
+        pending = []
+
+        def append(x):
+            nonlocal resized_video, num_frames
+            if num_frames + len(x) > len(resized_video):
+                grown = torch.empty((max(2 * len(resized_video), num_frames + len(x)), 3, height, width))
+                grown[:num_frames] = resized_video[:num_frames]
+                resized_video = grown
+            resized_video[num_frames:num_frames+len(x)] = x
+            num_frames += len(x)
+
+        for i, frame in enumerate(frames):
+            if keep_end is not None and i >= keep_end:
+                break
+            if i < keep_start:
+                continue
+            if self.resize_backend == 'torch':
+                if isinstance(frame, Image.Image):
+                    frame = np.asarray(convert_to_rgb(frame))
+                pending.append(frame)
+                if len(pending) == self.RESIZE_BATCH_SIZE:
+                    append(crop_and_resize_frames(np.stack(pending), resize_wh))
+                    pending = []
+            else:
+                if not isinstance(frame, Image.Image):
+                    frame = torchvision.transforms.functional.to_pil_image(frame)
+                cropped_image = convert_crop_and_resize(frame, resize_wh)
+                append(self.pil_to_tensor(cropped_image).unsqueeze(0))
+        if len(pending) > 0:
+            append(crop_and_resize_frames(np.stack(pending), resize_wh))
+        return resized_video[:num_frames]
+
+    def __call__(self, spec, mask_filepath, size_bucket=None, data=None):
+        # data is the contents of the file, if it was already read (e.g. when streaming tar files).
         is_video = (Path(spec[1]).suffix in VIDEO_EXTENSIONS)
+        filepath_or_file = self._open(spec, data)
 
-        if spec[0] is None:
-            tar_f = None
-            filepath_or_file = str(spec[1])
+        if size_bucket is not None and is_video and self.video_clip_mode == 'single_middle' and self.fast_single_middle:
+            estimated_num_frames = self._estimate_num_frames(filepath_or_file, Path(spec[1]).suffix)
         else:
-            tar_filename = spec[0]
-            if tar_filename not in self.tarfile_map:
-                self.tarfile_map[tar_filename] = tarfile.TarFile(tar_filename)
-            tar_f = self.tarfile_map[tar_filename]
-            filepath_or_file = tar_f.extractfile(str(spec[1]))
+            estimated_num_frames = None
 
         if is_video:
             assert self.support_video
-            num_frames = 0
-            for frame in imageio.v3.imiter(filepath_or_file, fps=self.framerate):
-                num_frames += 1
-                height, width = frame.shape[:2]
-            video = imageio.v3.imiter(filepath_or_file, fps=self.framerate)
+            video = imageio.v3.imiter(filepath_or_file, fps=self.framerate, extension=Path(spec[1]).suffix)
+            first_frame = next(video, None)
+            if first_frame is None:
+                raise RuntimeError(f'Video {spec[1]} has no frames')
+            height, width = first_frame.shape[:2]
+            video = itertools.chain([first_frame], video)
         else:
-            num_frames = 1
             pil_img = Image.open(filepath_or_file)
             height, width = pil_img.height, pil_img.width
             video = [pil_img]
@@ -116,11 +219,12 @@ class PreprocessMediaFile:
         if size_bucket is not None:
             size_bucket_width, size_bucket_height, size_bucket_frames = size_bucket
         else:
-            size_bucket_width, size_bucket_height, size_bucket_frames = width, height, num_frames
+            # number of frames is only known after decoding
+            size_bucket_width, size_bucket_height, size_bucket_frames = width, height, None
 
         height_rounded = round_to_nearest_multiple(size_bucket_height, self.round_height)
         width_rounded = round_to_nearest_multiple(size_bucket_width, self.round_width)
-        frames_rounded = round_down_to_multiple(size_bucket_frames - 1, self.round_frames) + 1
+        frames_rounded = round_down_to_multiple(size_bucket_frames - 1, self.round_frames) + 1 if size_bucket_frames is not None else None
         resize_wh = (width_rounded, height_rounded)
 
         if mask_filepath:
@@ -138,16 +242,33 @@ class PreprocessMediaFile:
         else:
             mask = None
 
-        resized_video = torch.empty((num_frames, 3, height_rounded, width_rounded))
-        for i, frame in enumerate(video):
-            if not isinstance(frame, Image.Image):
-                frame = torchvision.transforms.functional.to_pil_image(frame)
-            cropped_image = convert_crop_and_resize(frame, resize_wh)
-            resized_video[i, ...] = self.pil_to_tensor(cropped_image)
+        if not is_video:
+            resized_video = self._resize_frames(video, resize_wh)
+        elif frames_rounded is None:
+            resized_video = self._resize_frames(video, resize_wh, capacity=64)
+        else:
+            # Only decode the frames that extract_clips() keeps, when they are known up front.
+            if self.video_clip_mode == 'single_beginning':
+                resized_video = self._resize_frames(video, resize_wh, keep_end=frames_rounded, capacity=frames_rounded)
+            elif estimated_num_frames is not None and estimated_num_frames >= frames_rounded:
+                keep_start = int((estimated_num_frames - frames_rounded) / 2)
+                resized_video = self._resize_frames(video, resize_wh, keep_start, keep_start + frames_rounded, capacity=frames_rounded)
+                if len(resized_video) < frames_rounded:
+                    # the metadata overestimated the length, decode the whole video instead
+                    if hasattr(filepath_or_file, 'close'):
+                        filepath_or_file.close()
+                    filepath_or_file = self._open(spec, data)
+                    video = imageio.v3.imiter(filepath_or_file, fps=self.framerate, extension=Path(spec[1]).suffix)
+                    resized_video = self._resize_frames(video, resize_wh, capacity=max(estimated_num_frames, 1))
+            else:
+                resized_video = self._resize_frames(video, resize_wh, capacity=max(estimated_num_frames or 0, frames_rounded))
 
         if hasattr(filepath_or_file, 'close'):
             filepath_or_file.close()
 
+        if frames_rounded is None:
+            frames_rounded = round_down_to_multiple(len(resized_video) - 1, self.round_frames) + 1
+
         if not self.support_video:
             return [(resized_video.squeeze(0), mask)]
 
@@ -0,0 +1,137 @@
+import argparse
+import os.path
+import sys
+import time
+from collections import deque
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+import multiprocess as mp
+
+from utils import reduction
+from utils.task_channel import TaskServer, TaskClient
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_workers', type=int, default=4, help='Client processes, like the caching map workers.')
+parser.add_argument('--num_tasks', type=int, default=200, help='Tasks sent by each worker.')
+parser.add_argument('--size', type=int, nargs=2, default=[512, 512], help='Width and height of the image tensor in each task.')
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--encode_ms', type=float, default=0, help='Simulated encoder time per task, spent waiting like for a GPU.')
+parser.add_argument('--max_in_flight', type=int, nargs='+', default=[1, 4])
+# Each worker cycles through this many different tasks, so making tasks and checking results takes little time.
+NUM_DISTINCT_TASKS = 8
+
+args = parser.parse_args()
+
+
+def make_tasks(worker):
+    tasks = []
+    for i in range(NUM_DISTINCT_TASKS):
+        generator = torch.Generator().manual_seed(worker * NUM_DISTINCT_TASKS + i)
+        tensor = torch.rand((args.batch_size, 3, args.size[1], args.size[0]), generator=generator)
+        tasks.append(((0, tensor, None), encode_latents(tensor)))
+    return tasks
+
+
+def encode_latents(tensor):
+    # Dummy VAE: 8x downsampling to 4 channels.
+    latents = torch.nn.functional.avg_pool2d(tensor, 8)
+    return torch.cat([latents, latents[:, :1]], dim=1)
+
+
+def encode(task):
+    _, tensor, _ = task
+    if args.encode_ms > 0:
+        time.sleep(args.encode_ms / 1000)
+    return {'latents': encode_latents(tensor)}
+
+
+def check(worker, i, result, expected):
+    # Returns the number of wrong results (0 or 1). Workers keep going, so the server still gets every task.
+    if not torch.equal(result['latents'], expected):
+        print(f'WRONG RESULT: task {i} of worker {worker}')
+        return 1
+    return 0
+
+
+def manager_worker(worker, queue):
+    # The old path: each task goes through a Manager queue, each result comes back through a Pipe.
+    tasks = make_tasks(worker)
+    parent_conn, child_conn = mp.Pipe(duplex=False)
+    errors = 0
+    for i in range(args.num_tasks):
+        task, expected = tasks[i % len(tasks)]
+        queue.put(task + (child_conn,))
+        errors += check(worker, i, parent_conn.recv(), expected)
+    sys.exit(1 if errors > 0 else 0)
+
+
+def run_manager():
+    manager = mp.Manager()
+    queue = manager.Queue()
+    workers = [mp.Process(target=manager_worker, args=(worker, queue)) for worker in range(args.num_workers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for _ in range(args.num_workers * args.num_tasks):
+        task = queue.get()
+        task[-1].send(encode(task[:-1]))
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError('a worker got wrong results or failed')
+    manager.shutdown()
+    return elapsed
+
+
+def channel_worker(worker, client):
+    # Keeps up to max_in_flight tasks in flight.
+    tasks = make_tasks(worker)
+    in_flight = deque()
+    errors = 0
+    for i in range(args.num_tasks):
+        task, expected = tasks[i % len(tasks)]
+        in_flight.append((i, client.submit(task), expected))
+        if len(in_flight) == client.max_in_flight:
+            j, request_id, expected = in_flight.popleft()
+            errors += check(worker, j, client.result(request_id), expected)
+    for j, request_id, expected in in_flight:
+        errors += check(worker, j, client.result(request_id), expected)
+    sys.exit(1 if errors > 0 else 0)
+
+
+def run_channel(max_in_flight):
+    server = TaskServer()
+    client = TaskClient([server.address], max_in_flight=max_in_flight)
+    workers = [mp.Process(target=channel_worker, args=(worker, client)) for worker in range(args.num_workers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for _ in range(args.num_workers * args.num_tasks):
+        request = server.get()
+        request.reply(encode(request.task))
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError('a worker got wrong results or failed')
+    client.stop_servers()
+    assert server.get() is None
+    server.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    reduction.init_reductions()
+    num_tasks = args.num_workers * args.num_tasks
+    results = [('manager queue', run_manager())]
+    for max_in_flight in args.max_in_flight:
+        results.append((f'channel, {max_in_flight} in flight', run_channel(max_in_flight)))
+    print()
+    print(f'{args.num_workers} workers x {args.num_tasks} tasks, {args.batch_size}x3x{args.size[1]}x{args.size[0]} float32 per task, encode {args.encode_ms} ms')
+    print(f'{"path":<24} {"tasks/s":>10}')
+    for name, elapsed in results:
+        print(f'{name:<24} {num_tasks/elapsed:>10.1f}')
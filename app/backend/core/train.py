@@ -305,6 +305,10 @@ if __name__ == '__main__':
 #for windows===========================================================================
         dataset_util.NUM_PROC = 1 # Force 1 process on Windows
         print(f"Forcing NUM_PROC=1 on Windows (ignoring config value {map_num_proc})")
+    if cache_format_version := config.get('cache_format_version', None):
+        dataset_util.CACHE_FORMAT_VERSION = cache_format_version
+    dataset_util.SORT_CAPTIONS_BY_LENGTH = config.get('caching_sort_captions_by_length', False)
+    dataset_util.SHARED_INDEXES = config.get('shared_dataset_indexes', False)
 
     # Initialize distributed environment before deepspeed
     world_size, rank, local_rank = distributed_init(args)
@@ -439,7 +443,14 @@ if __name__ == '__main__':
         'steps_per_print': config.get('steps_per_print', 1),
     }
     caching_batch_size = config.get('caching_batch_size', 1)
-    dataset_manager = dataset_util.DatasetManager(model, regenerate_cache=regenerate_cache, trust_cache=args.trust_cache, caching_batch_size=caching_batch_size)
+    dataset_manager = dataset_util.DatasetManager(
+        model,
+        regenerate_cache=regenerate_cache,
+        trust_cache=args.trust_cache,
+        caching_batch_size=caching_batch_size,
+        vae_max_batch_size=config.get('caching_vae_max_batch_size', caching_batch_size),
+        vae_batch_timeout=config.get('caching_vae_batch_timeout_ms', 0) / 1000,
+    )
 
     train_data = dataset_util.Dataset(dataset_config, model, skip_dataset_validation=args.i_know_what_i_am_doing)
     dataset_manager.register(train_data)
@@ -809,9 +820,13 @@ if __name__ == '__main__':
     communication_data_type = config['lora']['dtype'] if 'lora' in config else config['model']['dtype']
     model_engine.communication_data_type = communication_data_type
 
+    prefetch_depth = config.get('dataloader_prefetch_depth', 0)
+    pin_memory = config.get('dataloader_pin_memory', False)
 #for windows===========================================================================
     num_workers = 0 # Force 0 workers on Windows to avoid multiprocessing issues
-    train_dataloader = dataset_util.PipelineDataLoader(train_data, model_engine, model_engine.gradient_accumulation_steps(), model, num_dataloader_workers=num_workers)
+    train_dataloader = dataset_util.PipelineDataLoader(
+        train_data, model_engine, model_engine.gradient_accumulation_steps(), model, num_dataloader_workers=num_workers, prefetch_depth=prefetch_depth, pin_memory=pin_memory
+    )
     steps_per_epoch = len(train_dataloader) // model_engine.gradient_accumulation_steps()
 
     scheduler_type = config.get('lr_scheduler', 'constant')
@@ -863,7 +878,9 @@ if __name__ == '__main__':
             pg['lr'] = config['force_constant_lr']
 
     eval_dataloaders = {
-        name: dataset_util.PipelineDataLoader(eval_data, model_engine, config['eval_gradient_accumulation_steps'], model, num_dataloader_workers=0)
+        name: dataset_util.PipelineDataLoader(
+            eval_data, model_engine, config['eval_gradient_accumulation_steps'], model, num_dataloader_workers=0, prefetch_depth=prefetch_depth, pin_memory=pin_memory
+        )
         for name, eval_data in eval_data_map.items()
     }
 
@@ -896,6 +913,9 @@ if __name__ == '__main__':
             tb_writer.add_scalar(f'train/loss', loss, x_axis)
             if hasattr(optimizer, '_grad_norm'):
                 tb_writer.add_scalar(f'train/grad_norm', optimizer._grad_norm, x_axis)
+            dataloader_wait_time, dataloader_prepare_time = train_dataloader.pop_timings()
+            tb_writer.add_scalar(f'train/dataloader_wait_sec', dataloader_wait_time, x_axis)
+            tb_writer.add_scalar(f'train/dataloader_prepare_sec', dataloader_prepare_time, x_axis)
             if wandb_enable:
                 wandb.log({'train/loss': loss, 'step': x_axis})
                 if hasattr(optimizer, '_grad_norm'):
@@ -0,0 +1,358 @@
+import os
+import mmap
+import queue
+import threading
+import time
+from collections import deque
+
+import torch
+from multiprocess.connection import Listener, Client, wait
+from multiprocess.shared_memory import SharedMemory
+from multiprocess import util
+
+if os.name == 'posix':
+    import _posixshmem
+
+
+# Requests a client can have sent but not yet received the result of. More than one keeps the GPU processes busy
+# while the client is receiving a result or preparing the next request.
+MAX_IN_FLIGHT = 4
+# Tensors are placed at multiples of this in the shared memory segments.
+TENSOR_ALIGNMENT = 64
+# Smallest shared memory segment, so small requests don't reallocate every time they grow a little.
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+
+def _align(x, alignment=TENSOR_ALIGNMENT):
+    return (x + alignment - 1) // alignment * alignment
+
+
+class _TensorRef:
+    # Stands in for a tensor in a message. The tensor bytes are in the shared memory segment sent with the message.
+    __slots__ = ['offset', 'dtype', 'shape']
+
+    def __init__(self, offset, dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return self.offset, self.dtype, self.shape
+
+    def __setstate__(self, state):
+        self.offset, self.dtype, self.shape = state
+
+
+def _nbytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def _flatten(obj, tensors):
+    # Replaces the tensors in obj with _TensorRefs, and appends (offset, tensor) to tensors for _write_tensors().
+    if torch.is_tensor(obj):
+        tensor = obj.detach().cpu().contiguous()
+        offset = _align(tensors[-1][0] + _nbytes(tensors[-1][1])) if len(tensors) > 0 else 0
+        tensors.append((offset, tensor))
+        return _TensorRef(offset, tensor.dtype, tuple(tensor.shape))
+    elif isinstance(obj, dict):
+        return {k: _flatten(v, tensors) for k, v in obj.items()}
+    elif isinstance(obj, tuple):
+        return tuple(_flatten(x, tensors) for x in obj)
+    elif isinstance(obj, list):
+        return [_flatten(x, tensors) for x in obj]
+    else:
+        return obj
+
+
+def _write_tensors(tensors, buf):
+    for offset, tensor in tensors:
+        nbytes = _nbytes(tensor)
+        if nbytes > 0:
+            dst = torch.frombuffer(buf, dtype=torch.uint8, count=nbytes, offset=offset)
+            dst.copy_(tensor.reshape(-1).view(torch.uint8))
+
+
+def _unflatten(obj, buf, copy):
+    # With copy=False, the tensors share memory with buf and are only valid until the segment is reused.
+    if isinstance(obj, _TensorRef):
+        numel = 1
+        for dim in obj.shape:
+            numel *= dim
+        if numel == 0:
+            return torch.empty(obj.shape, dtype=obj.dtype)
+        tensor = torch.frombuffer(buf, dtype=obj.dtype, count=numel, offset=obj.offset).view(obj.shape)
+        return tensor.clone() if copy else tensor
+    elif isinstance(obj, dict):
+        return {k: _unflatten(v, buf, copy) for k, v in obj.items()}
+    elif isinstance(obj, tuple):
+        return tuple(_unflatten(x, buf, copy) for x in obj)
+    elif isinstance(obj, list):
+        return [_unflatten(x, buf, copy) for x in obj]
+    else:
+        return obj
+
+
+def _close_segment(segment, unlink=False):
+    try:
+        segment.close()
+    except BufferError:
+        # A tensor still refers to it. The mapping goes away when that tensor does.
+        pass
+    if unlink:
+        segment.unlink()
+
+
+class _Segments:
+    '''Shared memory segments owned by one process, one per slot. Each grows as needed and is reused for every
+    message sent through its slot.'''
+
+    def __init__(self):
+        self.segments = {}
+
+    def write(self, slot, obj):
+        '''Copies the tensors in obj to the segment of slot. Returns (segment name, obj with the tensors replaced).'''
+        tensors = []
+        obj = _flatten(obj, tensors)
+        size = tensors[-1][0] + _nbytes(tensors[-1][1]) if len(tensors) > 0 else 0
+        if size == 0:
+            return None, obj
+        segment = self.segments.get(slot, None)
+        if segment is None or segment.size < size:
+            if segment is not None:
+                _close_segment(segment, unlink=True)
+            segment = SharedMemory(create=True, size=max(size, MIN_SEGMENT_SIZE))
+            self.segments[slot] = segment
+        _write_tensors(tensors, segment.buf)
+        return segment.name, obj
+
+    def close(self):
+        for segment in self.segments.values():
+            _close_segment(segment, unlink=True)
+        self.segments = {}
+
+
+class _Attachment:
+    '''Another process's shared memory segment, mapped into this one. Unlike SharedMemory(name=name), it isn't
+    registered with the resource tracker, which can be the owner's too, and then fails when the owner unlinks it.'''
+
+    def __init__(self, name):
+        self.name = name
+        if os.name == 'posix':
+            fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+            try:
+                self.mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            self.buf = memoryview(self.mmap)
+        else:
+            # no resource tracker on Windows
+            self.mmap = None
+            self.segment = SharedMemory(name=name)
+            self.buf = self.segment.buf
+
+    def close(self):
+        if self.mmap is None:
+            self.segment.close()
+        else:
+            self.buf.release()
+            self.mmap.close()
+
+
+class _Attachments:
+    '''Shared memory segments of another process, by the slot they belong to. Reattaches when a slot's segment has
+    been replaced by a bigger one.'''
+
+    def __init__(self):
+        self.segments = {}
+
+    def read(self, slot, name, obj, copy):
+        if name is None:
+            return _unflatten(obj, None, copy)
+        segment = self.segments.get(slot, None)
+        if segment is None or segment.name != name:
+            if segment is not None:
+                _close_segment(segment)
+            segment = _Attachment(name)
+            self.segments[slot] = segment
+        return _unflatten(obj, segment.buf, copy)
+
+    def close(self):
+        for segment in self.segments.values():
+            _close_segment(segment)
+        self.segments = {}
+
+
+class TaskRequest:
+    '''A task received by a TaskServer. Tensors in the task share memory with the client until reply() is called.'''
+
+    def __init__(self, connection, request_id, slot, task):
+        self.connection = connection
+        self.request_id = request_id
+        self.slot = slot
+        self.task = task
+        self.start_time = None
+
+    def reply(self, result, busy_time=None):
+        '''Sends back the result. busy_time is the time spent on the task, by default the time since get() returned it.'''
+        if busy_time is None:
+            busy_time = time.perf_counter() - self.start_time
+        self.connection.reply(self, result, busy_time)
+
+
+class _ServerConnection:
+    # One client connected to a TaskServer. Requests are read in a background thread, so the tensors of the next
+    # requests are already mapped when the current one finishes.
+
+    def __init__(self, conn, requests):
+        self.conn = conn
+        self.requests = requests
+        self.attachments = _Attachments()
+        self.segments = _Segments()
+        self.thread = threading.Thread(target=self._read_requests, daemon=True)
+        self.thread.start()
+
+    def _read_requests(self):
+        try:
+            while True:
+                message = self.conn.recv()
+                if message is None:
+                    # The client is done with every server.
+                    self.requests.put(None)
+                    break
+                request_id, slot, name, task = message
+                task = self.attachments.read(slot, name, task, copy=False)
+                self.requests.put(TaskRequest(self, request_id, slot, task))
+        except (EOFError, OSError):
+            # client process exited
+            pass
+        self.conn.close()
+
+    def reply(self, request, result, busy_time):
+        name, result = self.segments.write(request.slot, result)
+        self.conn.send((request.request_id, name, result, busy_time))
+
+    def close(self):
+        # The reader thread closes the socket once the client does. By now every client has received all its results.
+        self.attachments.close()
+        self.segments.close()
+
+
+class TaskServer:
+    '''Receives tasks from TaskClients in other processes on the same machine, for example the map workers of the
+    caching process, and sends back the results. Each process that runs tasks (one per GPU) has its own server.
+    Tensors in tasks and results are passed through shared memory, only small messages go through the socket.'''
+
+    def __init__(self):
+        self.authkey = os.urandom(32)
+        self.listener = Listener(authkey=self.authkey)
+        self.requests = queue.Queue()
+        self.connections = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._accept_connections, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        '''What a TaskClient needs to connect to this server. Picklable.'''
+        return self.listener.address, self.authkey
+
+    def _accept_connections(self):
+        while True:
+            conn = self.listener.accept()
+            if self.closed:
+                conn.close()
+                break
+            self.connections.append(_ServerConnection(conn, self.requests))
+
+    def get(self, timeout=None):
+        '''Returns the next TaskRequest, waiting for it if needed, or None once a client has called
+        TaskClient.stop_servers(). With a timeout, raises queue.Empty if there's no request within that many seconds.'''
+        request = self.requests.get(timeout=timeout)
+        if request is not None:
+            # for the time it took, sent back with the result
+            request.start_time = time.perf_counter()
+        return request
+
+    def close(self):
+        # Closing the listener doesn't interrupt accept(), so connect to it instead.
+        self.closed = True
+        Client(self.listener.address, authkey=self.authkey).close()
+        self.thread.join()
+        self.listener.close()
+        for connection in self.connections:
+            connection.close()
+
+
+class TaskClient:
+    '''Sends tasks to a set of TaskServers. Each task goes to the server with the fewest of this client's tasks in
+    flight. Can be pickled or inherited by forked processes, each of which makes its own connections when it first
+    submits a task. busy_time is the total time the servers spent on the tasks of this client, from get() to reply().'''
+
+    def __init__(self, addresses, max_in_flight=MAX_IN_FLIGHT):
+        self.addresses = addresses
+        self.max_in_flight = max_in_flight
+        self.pid = None
+        self.busy_time = 0.0
+
+    def __getstate__(self):
+        return {'addresses': self.addresses, 'max_in_flight': self.max_in_flight, 'pid': None, 'busy_time': 0.0}
+
+    def _connect(self):
+        if self.pid == os.getpid():
+            return
+        # Connections and segments inherited through fork belong to the parent process.
+        self.pid = os.getpid()
+        self.conns = [Client(address, authkey=authkey) for address, authkey in self.addresses]
+        self.in_flight = [{} for _ in self.conns]  # request id -> slot, for each server
+        self.free_slots = deque(range(self.max_in_flight))
+        self.segments = _Segments()
+        self.attachments = _Attachments()
+        self.results = {}
+        self.next_request_id = 0
+        util.Finalize(self, self.segments.close, exitpriority=0)
+
+    def submit(self, task):
+        '''Sends a task and returns its request id, for result(). Waits for a result first if max_in_flight tasks
+        are already in flight.'''
+        self._connect()
+        while len(self.free_slots) == 0:
+            self._receive()
+        slot = self.free_slots.popleft()
+        request_id = self.next_request_id
+        # ties go round robin, starting at a different server in each process
+        server = min(range(len(self.conns)), key=lambda i: (len(self.in_flight[i]), (i - request_id - self.pid) % len(self.conns)))
+        self.next_request_id += 1
+        name, task = self.segments.write(slot, task)
+        self.conns[server].send((request_id, slot, name, task))
+        self.in_flight[server][request_id] = slot
+        return request_id
+
+    def result(self, request_id):
+        '''Waits for and returns the result of a submitted task.'''
+        while request_id not in self.results:
+            self._receive()
+        return self.results.pop(request_id)
+
+    def __call__(self, task):
+        return self.result(self.submit(task))
+
+    def _receive(self):
+        # Receives at least one result.
+        waiting = [conn for conn, in_flight in zip(self.conns, self.in_flight) if len(in_flight) > 0]
+        assert len(waiting) > 0, 'no tasks in flight'
+        for conn in wait(waiting):
+            request_id, name, result, busy_time = conn.recv()
+            self.busy_time += busy_time
+            slot = self.in_flight[self.conns.index(conn)].pop(request_id)
+            self.results[request_id] = self.attachments.read(slot, name, result, copy=True)
+            self.free_slots.append(slot)
+
+    def stop_servers(self):
+        '''Makes TaskServer.get() return None in every server. Call once all results have been received.'''
+        self._connect()
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        self.segments.close()
+        self.attachments.close()
+        self.pid = None
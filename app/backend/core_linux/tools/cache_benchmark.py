@@ -0,0 +1,88 @@
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+import torch.nn.functional as F
+
+from utils.cache import Cache, FORMAT_VERSION_TORCH, FORMAT_VERSION_TENSOR
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_items', type=int, default=2000)
+parser.add_argument('--latent_shape', type=int, nargs='+', default=[16, 128, 128])
+parser.add_argument('--dtype', type=str, default='bfloat16')
+parser.add_argument('--smooth', action='store_true', help='Use spatially smooth data, closer to real VAE latents than white noise.')
+parser.add_argument('--compression', type=str, nargs='*', default=[], help='Also benchmark these codecs, e.g. zstd lz4 zlib.')
+parser.add_argument('--dir', type=str, default=None, help='Directory to create the benchmark caches in. Defaults to a temporary directory.')
+
+args = parser.parse_args()
+
+
+def make_item(i):
+    if args.smooth:
+        c, *spatial = args.latent_shape
+        low_res = torch.randn([1, c] + [max(x // 8, 1) for x in spatial])
+        latents = F.interpolate(low_res, size=spatial, mode='bilinear' if len(spatial) == 2 else 'trilinear')[0]
+    else:
+        latents = torch.randn(args.latent_shape)
+    return {
+        'latents': latents.to(getattr(torch, args.dtype)),
+        'mask': None,
+        'image_spec': (None, f'/data/images/{i}.jpg'),
+        'caption': ['a photo of something'],
+    }
+
+
+def write_cache(path, format_version, compression=None, byte_shuffle=False):
+    cache = Cache(path, 'benchmark', shard_size_gb=1, format_version=format_version, compression=compression, byte_shuffle=byte_shuffle)
+    cache.clear()
+    start = time.perf_counter()
+    for i in range(args.num_items):
+        cache.add(make_item(i))
+    cache.finalize_current_shard()
+    return time.perf_counter() - start
+
+
+def read_cache(path, use_mmap):
+    cache = Cache(path, 'benchmark', use_mmap=use_mmap)
+    start = time.perf_counter()
+    for i in range(len(cache)):
+        item = cache[i]
+        # touch the data so lazily mapped pages are actually read
+        item['latents'].float().sum()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    configs = [
+        ('torch', FORMAT_VERSION_TORCH, None, False, (False, True)),
+        ('tensor', FORMAT_VERSION_TENSOR, None, False, (False, True)),
+    ]
+    for codec in args.compression:
+        configs.append((codec, FORMAT_VERSION_TENSOR, codec, False, (True,)))
+        configs.append((codec + '+shuf', FORMAT_VERSION_TENSOR, codec, True, (True,)))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        results = []
+        for name, format_version, compression, byte_shuffle, mmap_modes in configs:
+            path = os.path.join(tmpdir, name)
+            write_time = write_cache(path, format_version, compression, byte_shuffle)
+            shard_bytes = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.endswith('.bin'))
+            for use_mmap in mmap_modes:
+                # first pass warms the page cache so we measure decode cost, not disk
+                read_cache(path, use_mmap)
+                read_time = read_cache(path, use_mmap)
+                results.append((name, use_mmap, write_time, read_time, shard_bytes))
+
+        uncompressed_bytes = next(r[4] for r in results if r[0] == 'tensor')
+        print()
+        print(f'{"format":<12} {"mmap":<6} {"write items/s":>14} {"read items/s":>14} {"read MB/s":>10} {"shard MB":>10} {"ratio":>7}')
+        for name, use_mmap, write_time, read_time, shard_bytes in results:
+            print(
+                f'{name:<12} {str(use_mmap):<6} {args.num_items/write_time:>14.1f} {args.num_items/read_time:>14.1f} '
+                f'{uncompressed_bytes/read_time/1e6:>10.1f} {shard_bytes/1e6:>10.1f} {uncompressed_bytes/shard_bytes:>7.2f}'
+            )
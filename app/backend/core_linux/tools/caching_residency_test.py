@@ -0,0 +1,174 @@
+import argparse
+import os.path
+import sys
+import tempfile
+from pathlib import Path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import torch
+from torch import nn
+import deepspeed
+from PIL import Image
+
+from utils import dataset as dataset_util
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_images', type=int, default=12, help='Images in each of the train and eval datasets.')
+parser.add_argument('--caching_batch_size', type=int, default=2)
+parser.add_argument('--num_proc', type=int, nargs='+', default=[1, 2], help='Values of map_num_proc. With 1, the Windows version caches in a thread.')
+
+args = parser.parse_args()
+
+# Parameter counts of the fake submodels. Their parameters are on the meta device, so they take no memory.
+VAE_SIZE = 80 * 1024**2
+TEXT_ENCODER_SIZES = [2 * 1024**3, 300 * 1024**2]
+
+# (name, device) of every submodel move, in order
+moves = []
+
+
+class FakeSubmodel(nn.Module):
+    # Records moves instead of making them.
+
+    def __init__(self, name, size):
+        super().__init__()
+        self.name = name
+        self.weight = nn.Parameter(torch.empty(size, device='meta'))
+
+    def to(self, device):
+        moves.append((self.name, str(device)))
+        return self
+
+
+class Model:
+    name = 'residency_test'
+    framerate = None
+    pixels_round_to_multiple = 16
+
+    def __init__(self):
+        self.vae = FakeSubmodel('vae', VAE_SIZE)
+        self.text_encoders = [FakeSubmodel(f'text_encoder_{i+1}', size) for i, size in enumerate(TEXT_ENCODER_SIZES)]
+
+    def get_vae(self):
+        return self.vae
+
+    def get_text_encoders(self):
+        return self.text_encoders
+
+    def get_call_vae_fn(self, vae):
+        return lambda tensor: {'latents': torch.nn.functional.avg_pool2d(tensor, 8)}
+
+    def get_call_text_encoder_fn(self, text_encoder):
+        return lambda caption, is_video: {f'{text_encoder.name}_embeds': [torch.full((len(c.split()), 4), float(len(c))) for c in caption]}
+
+    def get_preprocess_media_file_fn(self):
+        return preprocess_media_file
+
+
+def preprocess_media_file(spec, mask_path, size_bucket, data=None):
+    w, h = size_bucket[-3:-1]
+    image = Image.open(spec[1]).convert('RGB').resize((w, h))
+    return [(torch.from_numpy(np.array(image)).permute(2, 0, 1).float() / 255, None)]
+
+
+def make_images(path, seed):
+    os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    for i in range(args.num_images):
+        w, h = int(rng.integers(40, 120)), int(rng.integers(40, 120))
+        Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)).save(os.path.join(path, f'{i}.png'))
+        with open(os.path.join(path, f'{i}.txt'), 'w') as f:
+            f.write('caption ' * (1 + i % 5))
+
+
+def dataset_config(path):
+    return {
+        'directory': [{'path': path, 'num_repeats': 1}],
+        'resolutions': [64],
+        'enable_ar_bucket': True,
+        'min_ar': 0.5,
+        'max_ar': 2.0,
+        'num_ar_buckets': 3,
+    }
+
+
+def cache(paths):
+    # Like train.py, with a train and an eval dataset registered to one DatasetManager. Returns the manager and the
+    # datasets.
+    moves.clear()
+    # Stores are kept for the lifetime of the process, start over like a new training run would.
+    dataset_util._text_embedding_stores.clear()
+    model = Model()
+    manager = dataset_util.DatasetManager(model, caching_batch_size=args.caching_batch_size)
+    datasets = [dataset_util.Dataset(dataset_config(path), model, skip_dataset_validation=True) for path in paths]
+    for ds in datasets:
+        manager.register(ds)
+    manager.cache(unload_models=False)
+    return manager, datasets
+
+
+def expected_moves(submodels):
+    # Each submodel is moved to the GPU once, right after the previous one is moved off it.
+    expected = []
+    for i, name in enumerate(submodels):
+        if i > 0:
+            expected.append((submodels[i-1], 'cpu'))
+        expected.append((name, 'cuda'))
+    return expected
+
+
+def check_items(description, datasets):
+    # Reads every item of the cached datasets, like training does. Returns the number of failed checks (0 or 1).
+    try:
+        for ds in datasets:
+            for directory_dataset in ds.directory_datasets:
+                for size_bucket_dataset in directory_dataset.get_size_bucket_datasets():
+                    for i in range(len(size_bucket_dataset)):
+                        item = size_bucket_dataset[i]
+                        for text_encoder in Model().text_encoders:
+                            assert f'{text_encoder.name}_embeds' in item
+    except Exception as e:
+        print(f'FAILED: {description}: reading the cached items raised {e!r}')
+        return 1
+    return 0
+
+
+def check(description, manager, datasets, submodels):
+    # Returns the number of failed checks.
+    failures = check_items(description, datasets)
+    expected = expected_moves(submodels)
+    sizes = {'vae': VAE_SIZE} | {f'text_encoder_{i+1}': size for i, size in enumerate(TEXT_ENCODER_SIZES)}
+    # float32 parameters
+    expected_bytes = sum(sizes[name] * 4 for name, _ in expected)
+    swaps = sum(manager.num_moves_to_gpu)
+    if moves != expected or swaps != len(submodels) or manager.bytes_moved != expected_bytes:
+        print(f'FAILED: {description}: {swaps} swaps, {manager.bytes_moved} bytes moved, moves {moves}, expected {expected}')
+        return failures + 1
+    print(f'{description}: {swaps} swaps, {manager.bytes_moved / 1024**3:.2f} GiB moved')
+    return failures
+
+
+if __name__ == '__main__':
+    deepspeed.init_distributed('gloo', auto_mpi_discovery=False, init_method=Path(tempfile.mktemp()).as_uri(), rank=0, world_size=1)
+    failures = 0
+    text_encoders = [f'text_encoder_{i+1}' for i in range(len(TEXT_ENCODER_SIZES))]
+    for num_proc in args.num_proc:
+        dataset_util.NUM_PROC = num_proc
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, 'train'), os.path.join(tmp, 'eval')]
+            for seed, path in enumerate(paths):
+                make_images(path, seed)
+
+            failures += check(f'num_proc={num_proc}, new cache', *cache(paths), ['vae'] + text_encoders)
+            failures += check(f'num_proc={num_proc}, already cached', *cache(paths), [])
+            # Only the text embeddings of the changed caption are cached, so the VAE stays where it is.
+            with open(os.path.join(paths[1], '0.txt'), 'w') as f:
+                f.write('edited caption')
+            failures += check(f'num_proc={num_proc}, edited caption', *cache(paths), text_encoders)
+
+    if failures > 0:
+        print(f'{failures} checks failed')
+        sys.exit(1)
+    print('Every submodel with something to cache was moved to the GPU once, and every cached item could be read')
@@ -0,0 +1,103 @@
+import argparse
+import gc
+import hashlib
+import os.path
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+
+from utils.dataset import PipelineDataLoader
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_batches', type=int, default=7, help='Batches per epoch.')
+parser.add_argument('--gradient_accumulation_steps', type=int, default=2)
+parser.add_argument('--epochs', type=int, default=3)
+parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2])
+parser.add_argument('--prefetch_depth', type=int, nargs='+', default=[0, 2])
+
+args = parser.parse_args()
+
+
+class BatchDataset(torch.utils.data.Dataset):
+    # Deterministic batches that differ in every byte from one index to the next.
+    dataset_config = {}
+
+    def __len__(self):
+        return args.num_batches
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(idx)
+        return {
+            'latents': torch.randn((args.gradient_accumulation_steps * 2, 4, 8, 8), generator=generator),
+            'mask': None,
+        }
+
+
+class Model:
+    def prepare_inputs(self, batch, timestep_quantile=None):
+        latents = batch['latents']
+        return (latents,), (latents.clone(), batch['mask'])
+
+
+class ModelEngine:
+    is_pipe_parallel = False
+
+
+def make_dataloader(num_workers, prefetch_depth):
+    return PipelineDataLoader(
+        BatchDataset(), ModelEngine(), args.gradient_accumulation_steps, Model(), num_dataloader_workers=num_workers, prefetch_depth=prefetch_depth
+    )
+
+
+def run_steps(dataloader, num_steps):
+    # Same as get_data_iterator_for_step() in train.py. Returns (epoch, hash of the micro batches) for each step.
+    steps = []
+    dataloader_iter = iter(dataloader)
+    for _ in range(num_steps):
+        micro_batches = [next(dataloader_iter) for _ in range(args.gradient_accumulation_steps)]
+        h = hashlib.sha256()
+        for features, label in micro_batches:
+            for tensor in features + label:
+                h.update(tensor.numpy().tobytes())
+        steps.append((dataloader.epoch, h.hexdigest()))
+    return steps
+
+
+def close(dataloader):
+    # Stop the prefetch thread and DataLoader workers now, rather than in workers forked for the next DataLoader.
+    dataloader.data.close()
+    del dataloader
+    gc.collect()
+
+
+def run(num_workers, prefetch_depth, resume_step, total_steps):
+    dataloader = make_dataloader(num_workers, prefetch_depth)
+    steps = run_steps(dataloader, resume_step)
+    state_dict = dataloader.state_dict()
+    close(dataloader)
+    if resume_step < total_steps:
+        dataloader = make_dataloader(num_workers, prefetch_depth)
+        dataloader.load_state_dict(state_dict)
+        steps += run_steps(dataloader, total_steps - resume_step)
+        close(dataloader)
+    return steps
+
+
+if __name__ == '__main__':
+    total_steps = args.num_batches * args.epochs
+    failures = 0
+    for num_workers in args.num_workers:
+        for prefetch_depth in args.prefetch_depth:
+            expected = run(num_workers, prefetch_depth, total_steps, total_steps)
+            for resume_step in range(1, total_steps):
+                steps = run(num_workers, prefetch_depth, resume_step, total_steps)
+                if steps != expected:
+                    failures += 1
+                    print(f'MISMATCH: num_workers={num_workers}, prefetch_depth={prefetch_depth}, resumed after step {resume_step}')
+            print(f'num_workers={num_workers}, prefetch_depth={prefetch_depth}: checked resuming after each of {total_steps - 1} steps')
+    if failures > 0:
+        print(f'{failures} resumed runs differed from the uninterrupted run')
+        sys.exit(1)
+    print('All resumed runs matched the uninterrupted run')
@@ -0,0 +1,64 @@
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import torch
+from PIL import Image
+
+from models.base import PreprocessMediaFile
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dir', type=str, default=None, help='Directory of images to benchmark on. Defaults to generated JPEGs of mixed sizes.')
+parser.add_argument('--num_images', type=int, default=200, help='Number of images to generate if --dir is not given.')
+parser.add_argument('--size', type=int, nargs=2, default=[1024, 1024], help='Size bucket width and height.')
+parser.add_argument('--num_threads', type=int, default=1, help='Torch threads. Caching runs with 1 thread per map worker.')
+
+args = parser.parse_args()
+
+
+def generate_images(path):
+    rng = np.random.default_rng(0)
+    for i in range(args.num_images):
+        width, height = rng.integers(512, 3000, size=2)
+        # smooth random image, closer to a photo than noise
+        low_res = rng.integers(0, 256, size=(max(height // 64, 1), max(width // 64, 1), 3), dtype=np.uint8)
+        Image.fromarray(low_res).resize((int(width), int(height)), Image.Resampling.BILINEAR).save(os.path.join(path, f'{i}.jpg'), quality=90)
+
+
+def run(files, backend):
+    preprocess = PreprocessMediaFile({}, resize_backend=backend)
+    size_bucket = (args.size[0], args.size[1], 1)
+    results = []
+    start = time.perf_counter()
+    for file in files:
+        results.append(preprocess((None, file), None, size_bucket)[0][0])
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(args.num_threads)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        image_dir = args.dir
+        if image_dir is None:
+            image_dir = tmpdir
+            generate_images(image_dir)
+        files = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')))
+
+        pil_time, pil_results = run(files, 'pil')
+        torch_time, torch_results = run(files, 'torch')
+
+    # differences in uint8 levels
+    diffs = torch.cat([((a - b).abs() * 127.5).flatten() for a, b in zip(pil_results, torch_results)])
+    print()
+    print(f'{len(files)} images, size bucket {args.size[0]}x{args.size[1]}, {args.num_threads} thread(s)')
+    print(f'{"backend":<8} {"images/s":>10}')
+    print(f'{"pil":<8} {len(files)/pil_time:>10.1f}')
+    print(f'{"torch":<8} {len(files)/torch_time:>10.1f}')
+    # quantile() has an input size limit, so estimate the percentile from a sample
+    sample = diffs[torch.randint(len(diffs), (1_000_000,))]
+    print(f'difference in uint8 levels: mean {diffs.mean():.3f}, 99th percentile {sample.quantile(0.99):.1f}, max {diffs.max():.1f}')
@@ -2,38 +2,293 @@ import sqlite3
 from pathlib import Path
 import os
 import io
-from collections import defaultdict
+import mmap
+import json
+import struct
+import zlib
 
+import numpy as np
 import torch
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# On-disk record format versions, stored in metadata.db.
+# 1: every record is a torch.save() blob of the item dict.
+# 2: tensor-native records, see encode_record().
+FORMAT_VERSION_TORCH = 1
+FORMAT_VERSION_TENSOR = 2
+LATEST_FORMAT_VERSION = FORMAT_VERSION_TENSOR
+
+# Tensor-native record layout. A record is a fixed header, one entry per tensor, a small JSON side table holding
+# everything that isn't a tensor (captions, image_spec, ...), and then the raw tensor bytes. Tensors can be rebuilt
+# directly on top of a memory-mapped shard without any copy or unpickling.
+# Records written by torch.save() start with a zip header instead, so both kinds can be read from the same shard.
+RECORD_MAGIC = b'DPCR'
+RECORD_ALIGNMENT = 64
+RECORD_HEADER = struct.Struct('<4sIII')  # magic, num tensors, side table length, data start
+TENSOR_ENTRY = struct.Struct('<BB6xQ')  # dtype code, ndim, data offset. Followed by ndim uint64 dims.
+RECORD_DTYPES = [
+    torch.float32,
+    torch.float16,
+    torch.bfloat16,
+    torch.float64,
+    torch.uint8,
+    torch.int8,
+    torch.int16,
+    torch.int32,
+    torch.int64,
+    torch.bool,
+    torch.float8_e4m3fn,
+    torch.float8_e5m2,
+]
+RECORD_DTYPE_CODES = {dtype: i for i, dtype in enumerate(RECORD_DTYPES)}
+
+# Optional per-shard compression of the tensor bytes of each record. The header and side table are never compressed.
+# zstd and lz4 are used if installed, zlib is always available.
+COMPRESSION_CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if zstandard is not None:
+    COMPRESSION_CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+if lz4 is not None:
+    COMPRESSION_CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def resolve_compression(compression):
+    '''Maps the user setting to an available codec name, or None for no compression.'''
+    if compression in (None, False, 'none'):
+        return None
+    if compression is True or compression == 'auto':
+        for codec in ('zstd', 'lz4', 'zlib'):
+            if codec in COMPRESSION_CODECS:
+                return codec
+    if compression in COMPRESSION_CODECS:
+        return compression
+    if compression in ('zstd', 'lz4'):
+        print(f'[CACHE] Compression codec {compression} is not installed, falling back to zlib')
+        return 'zlib'
+    raise ValueError(f'Unknown cache compression codec: {compression}')
+
+
+def _should_shuffle(dtype):
+    # Byte shuffling groups the sign/exponent bytes of all values together, which makes float data far more
+    # compressible. It's lossless and pointless for single byte types.
+    return dtype.is_floating_point and dtype.itemsize > 1
+
+
+def _shuffle_bytes(values, itemsize):
+    # (n, itemsize) -> (itemsize, n). Copying one byte column at a time is much faster than a generic transpose.
+    values = values.reshape(-1, itemsize)
+    shuffled = np.empty((itemsize, len(values)), dtype=np.uint8)
+    for i in range(itemsize):
+        shuffled[i] = values[:, i]
+    return shuffled
+
+
+def _unshuffle_bytes(shuffled, itemsize):
+    shuffled = shuffled.reshape(itemsize, -1)
+    values = np.empty((shuffled.shape[1], itemsize), dtype=np.uint8)
+    for i in range(itemsize):
+        values[:, i] = shuffled[i]
+    return values
+
+
+# Location of every item, in item order. Kept in memory as one packed array and saved as the index.npy sidecar.
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('size', '<i8')])
+
+
+def _align(x, alignment=RECORD_ALIGNMENT):
+    return (x + alignment - 1) // alignment * alignment
+
+
+def encode_record(item, compression=None, byte_shuffle=False):
+    '''Encodes an item into the tensor-native record layout. Returns a list of buffers to be written in order.
+    If compression is given, the tensor bytes are (optionally byte shuffled and) compressed as a single block.'''
+    tensors = []
+
+    def to_side_table(obj):
+        if torch.is_tensor(obj):
+            tensors.append(obj.detach().cpu().contiguous())
+            return {'__tensor__': len(tensors) - 1}
+        elif isinstance(obj, dict):
+            return {k: to_side_table(v) for k, v in obj.items()}
+        elif isinstance(obj, tuple):
+            return {'__tuple__': [to_side_table(x) for x in obj]}
+        elif isinstance(obj, list):
+            return [to_side_table(x) for x in obj]
+        else:
+            return obj
+
+    side_table = json.dumps(to_side_table(item), separators=(',', ':')).encode()
+
+    entries = []
+    data = []
+    data_offset = 0
+    for tensor in tensors:
+        entries.append(TENSOR_ENTRY.pack(RECORD_DTYPE_CODES[tensor.dtype], tensor.ndim, data_offset))
+        entries.append(struct.pack(f'<{tensor.ndim}Q', *tensor.shape))
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > 0:
+            tensor_bytes = tensor.reshape(-1).view(torch.uint8).numpy()
+            if compression is not None and byte_shuffle and _should_shuffle(tensor.dtype):
+                tensor_bytes = _shuffle_bytes(tensor_bytes, tensor.element_size())
+            data.append(tensor_bytes)
+        padding = _align(nbytes) - nbytes
+        if padding > 0:
+            data.append(bytes(padding))
+        data_offset += nbytes + padding
+
+    header_size = RECORD_HEADER.size + sum(len(x) for x in entries) + len(side_table)
+    data_start = _align(header_size)
+    header = [RECORD_HEADER.pack(RECORD_MAGIC, len(tensors), len(side_table), data_start)] + entries + [side_table, bytes(data_start - header_size)]
+    if compression is not None:
+        # No padding after the compressed block. All records in a shard share the codec, so alignment doesn't matter.
+        compress_fn, _ = COMPRESSION_CODECS[compression]
+        data = [compress_fn(b''.join(data))]
+    return header + data
+
+
+def decode_record(buffer, offset, size, compression=None, byte_shuffle=False):
+    '''Decodes the record at buffer[offset:offset+size]. Tensors share memory with the buffer when possible.'''
+    magic, num_tensors, side_table_len, data_start = RECORD_HEADER.unpack_from(buffer, offset)
+    if magic != RECORD_MAGIC:
+        # legacy torch.save() record
+        return torch.load(io.BytesIO(buffer[offset:offset+size]), map_location='cpu')
+
+    if compression is not None:
+        _, decompress_fn = COMPRESSION_CODECS[compression]
+        with memoryview(buffer) as view:
+            data = bytearray(decompress_fn(view[offset+data_start:offset+size]))
+        data_buffer, data_base = data, 0
+    else:
+        data_buffer, data_base = buffer, offset + data_start
+
+    tensors = []
+    pos = offset + RECORD_HEADER.size
+    for _ in range(num_tensors):
+        dtype_code, ndim, data_offset = TENSOR_ENTRY.unpack_from(buffer, pos)
+        pos += TENSOR_ENTRY.size
+        shape = struct.unpack_from(f'<{ndim}Q', buffer, pos)
+        pos += 8 * ndim
+        dtype = RECORD_DTYPES[dtype_code]
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        if numel == 0:
+            tensors.append(torch.empty(shape, dtype=dtype))
+            continue
+        if compression is not None and byte_shuffle and _should_shuffle(dtype):
+            shuffled = np.frombuffer(data_buffer, dtype=np.uint8, count=numel*dtype.itemsize, offset=data_base+data_offset)
+            tensor = torch.from_numpy(_unshuffle_bytes(shuffled, dtype.itemsize)).view(dtype)
+        else:
+            tensor = torch.frombuffer(data_buffer, dtype=dtype, count=numel, offset=data_base+data_offset)
+        tensors.append(tensor.view(shape))
+    side_table = json.loads(bytes(buffer[pos:pos+side_table_len]))
+
+    def from_side_table(obj):
+        if isinstance(obj, dict):
+            if '__tensor__' in obj:
+                return tensors[obj['__tensor__']]
+            if '__tuple__' in obj:
+                return tuple(from_side_table(x) for x in obj['__tuple__'])
+            return {k: from_side_table(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [from_side_table(x) for x in obj]
+        else:
+            return obj
+
+    return from_side_table(side_table)
+
+
+def encode_item(item, format_version, compression=None, byte_shuffle=False):
+    if format_version == FORMAT_VERSION_TENSOR:
+        return encode_record(item, compression=compression, byte_shuffle=byte_shuffle)
+    elif format_version == FORMAT_VERSION_TORCH:
+        buffer = io.BytesIO()
+        torch.save(item, buffer)
+        return [buffer.getbuffer()]
+    else:
+        raise ValueError(f'Unknown cache format version: {format_version}')
+
 
 class Cache:
-    def __init__(self, path: str, fingerprint: str, shard_size_gb=1):
+    def __init__(self, path: str, fingerprint: str, shard_size_gb=1, use_mmap=True, format_version=None, flush_every=1000, compression=None, byte_shuffle=False, previous_fingerprint=None, read_only=False):
         self.path = Path(path)
         self.fingerprint = fingerprint
+        # An existing cache with this fingerprint is kept and re-fingerprinted instead of cleared.
+        self.previous_fingerprint = previous_fingerprint
         self.metadata_db = self.path / 'metadata.db'
+        self.index_file = self.path / 'index.npy'
         self.shard_size_gb = shard_size_gb
+        # mmap each shard once and rebuild tensors directly from the mapped pages, instead of seek + read per item.
+        self.use_mmap = use_mmap
+        # Format to write new records in. Existing items in another format are migrated when the cache is opened.
+        # None means keep whatever format the cache already has (used when only reading).
+        assert format_version in (None, FORMAT_VERSION_TORCH, FORMAT_VERSION_TENSOR)
+        self.requested_format_version = format_version
+        # Index rows are buffered and written to the database in one transaction every this many items.
+        self.flush_every = flush_every
+        # Codec for new shards. Each shard's codec is stored in metadata.db, so readers don't need to know the setting.
+        self.compression = resolve_compression(compression)
+        self.byte_shuffle = byte_shuffle
+        # Memory map the index sidecar instead of loading a private copy of it, so all processes reading this cache
+        # share the same pages. Nothing can be added.
+        self.read_only = read_only
         os.makedirs(self.path, exist_ok=True)
 
         self.init()
 
 
     def __len__(self):
-        return len(self.items)
+        return self.num_items
 
 
     def __getitem__(self, idx):
         assert isinstance(idx, int)
-        shard_id, shard_index = self.items[idx]
-        offset, size = self.shard_metadata[shard_id][shard_index]
+        if idx < 0 or idx >= self.num_items:
+            raise IndexError(f'Cache index {idx} out of range for cache of length {self.num_items}')
+        shard_id, offset, size = self.index[idx].tolist()
+        # Open files and mappings are per process. DataLoader workers are forked after the parent may have already
+        # read some items, so drop anything inherited and reopen.
+        if self.open_files_pid != os.getpid():
+            self.open_files = {}
+            self.open_files_pid = os.getpid()
+        if self.use_mmap:
+            mapping = self.open_files.get(shard_id, None)
+            if mapping is None or len(mapping) < offset + size:
+                # (re)map if the shard grew since it was mapped
+                with open(self.path / f'shard_{shard_id}.bin', 'rb') as f:
+                    # ACCESS_COPY so the returned tensors are writable. Pages are only copied if actually written to.
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                self.open_files[shard_id] = mapping
+            return decode_record(mapping, offset, size, *self.shard_codecs.get(shard_id, (None, False)))
         if shard_id not in self.open_files:
             self.open_files[shard_id] = open(self.path / f'shard_{shard_id}.bin', 'rb')
         f = self.open_files[shard_id]
         f.seek(offset)
-        byte_string = f.read(size)
-        buffer = io.BytesIO(byte_string)
-        item = torch.load(buffer, map_location='cpu')
-        return item
+        buffer = bytearray(size)
+        f.readinto(buffer)
+        return decode_record(buffer, 0, size, *self.shard_codecs.get(shard_id, (None, False)))
+
+
+    def __getstate__(self):
+        # File handles, mappings and the database connection can't be sent to other processes. Readers reopen shards lazily.
+        state = self.__dict__.copy()
+        state['con'] = None
+        state['shard_file'] = None
+        state['open_files'] = {}
+        return state
 
 
     def init(self):
@@ -48,91 +303,437 @@ class Cache:
             existing_fingerprint = existing_fingerprint[0]
             print(f'[CACHE] Existing cache has fingerprint {existing_fingerprint}')
             if self.fingerprint != existing_fingerprint:
-                print('[CACHE] Fingerprint changed, deleting existing cache files')
-                self.clear()
-                return
+                if self.previous_fingerprint is not None and existing_fingerprint == self.previous_fingerprint:
+                    print(f'[CACHE] Keeping existing cache, updating fingerprint to {self.fingerprint}')
+                    self.con.execute('UPDATE fingerprint SET value = ?', (self.fingerprint,))
+                else:
+                    print('[CACHE] Fingerprint changed, deleting existing cache files')
+                    self.clear()
+                    return
         else:
             print(f'[CACHE] Storing new fingerprint: {self.fingerprint}')
             self.con.execute('INSERT INTO fingerprint VALUES(?)', (self.fingerprint,))
 
-        # items table, current length, next shard index
-        self.con.execute('CREATE TABLE IF NOT EXISTS items(shard, shard_index)')
-        self.items = self.con.execute('SELECT shard, shard_index FROM items').fetchall() or []
-        max_existing_shard = -1
-        for shard, _ in self.items:
-            max_existing_shard = max(max_existing_shard, shard)
-        self.shard = max_existing_shard + 1  # current shard to write to
+        # One row per item, in item order. idx is the rowid, so rows come back in order without sorting.
+        # key optionally identifies what the item was computed from, see set_order().
+        self.con.execute('CREATE TABLE IF NOT EXISTS records(idx INTEGER PRIMARY KEY, shard, offset, size, key)')
+        if 'key' not in [row[1] for row in self.con.execute('PRAGMA table_info(records)').fetchall()]:
+            self.con.execute('ALTER TABLE records ADD COLUMN key')
+        self.con.execute('CREATE TABLE IF NOT EXISTS index_file(num_items)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS shards(shard INTEGER PRIMARY KEY, compression, byte_shuffle)')
+        self.shard_codecs = {
+            shard_id: (compression, bool(byte_shuffle))
+            for shard_id, compression, byte_shuffle in self.con.execute('SELECT shard, compression, byte_shuffle FROM shards').fetchall()
+        }
+        self._convert_legacy_tables()
+        self._load_index()
+        self.pending = []
         self.shard_file = None
+        if not self.read_only:
+            self._recover_shards()
+        self.shard = int(self.index['shard'][:self.num_items].max()) + 1 if self.num_items > 0 else 0  # next shard to write to
         print(f'[CACHE] Existing cache length: {len(self)}')
+        self.open_files = {}
+        self.open_files_pid = os.getpid()
 
-        # shard metadata
-        self.shard_metadata = defaultdict(list)
-        for table_name, in self.con.execute('SELECT name FROM sqlite_master').fetchall():
+        # record format
+        self.con.execute('CREATE TABLE IF NOT EXISTS format(version)')
+        existing_format_version = self.con.execute('SELECT version FROM format').fetchone()
+        if existing_format_version is not None:
+            existing_format_version = existing_format_version[0]
+        elif len(self) > 0:
+            # caches from before the format table existed only contain torch.save() records
+            existing_format_version = FORMAT_VERSION_TORCH
+        self.format_version = self.requested_format_version or existing_format_version or LATEST_FORMAT_VERSION
+        if self.compression is not None and self.format_version != FORMAT_VERSION_TENSOR:
+            print(f'[CACHE] Compression is only supported for format version {FORMAT_VERSION_TENSOR}, not compressing')
+            self.compression = None
+        if existing_format_version is not None and existing_format_version != self.format_version and len(self) > 0:
+            self.migrate(existing_format_version)
+        if existing_format_version != self.format_version:
+            self.con.execute('DELETE FROM format')
+            self.con.execute('INSERT INTO format VALUES(?)', (self.format_version,))
+
+        # commit
+        self.con.commit()
+
+
+    def _convert_legacy_tables(self):
+        # Older caches have an items(shard, shard_index) table plus one shard_N(offset, size) table per shard.
+        # Convert them to the records table in one transaction.
+        table_names = [name for name, in self.con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+        if 'items' not in table_names:
+            return
+        print('[CACHE] Converting legacy index tables')
+        shard_metadata = {}
+        for table_name in table_names:
             if table_name.startswith('shard_'):
                 shard_id = int(table_name.split('_')[-1])
-                for entry in self.con.execute(f'SELECT offset, size FROM {table_name}').fetchall():
-                    self.shard_metadata[shard_id].append(entry)
-        self.open_files = {}
+                shard_metadata[shard_id] = self.con.execute(f'SELECT offset, size FROM {table_name} ORDER BY rowid').fetchall()
+        rows = []
+        for shard_id, shard_index in self.con.execute('SELECT shard, shard_index FROM items ORDER BY rowid').fetchall():
+            offset, size = shard_metadata[shard_id][shard_index]
+            rows.append((len(rows), shard_id, offset, size))
+        self.con.execute('DELETE FROM records')
+        self.con.executemany('INSERT INTO records VALUES(?, ?, ?, ?, NULL)', rows)
+        self.con.execute('DROP TABLE items')
+        for table_name in table_names:
+            if table_name.startswith('shard_'):
+                self.con.execute(f'DROP TABLE {table_name}')
+        self.con.commit()
 
-        # commit
+
+    def _load_index(self):
+        # The index sidecar is a packed (shard, offset, size) array for all items, written whenever a shard is
+        # finalized. It is only trusted if it matches the number of committed rows in the database.
+        num_rows = self.con.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        num_indexed = self.con.execute('SELECT num_items FROM index_file').fetchone()
+        index = None
+        if num_indexed is not None and num_indexed[0] == num_rows and self.index_file.exists():
+            index = np.load(self.index_file)
+            if index.dtype != INDEX_DTYPE or len(index) != num_rows:
+                index = None
+        # number of items in the sidecar, None if it needs to be rewritten
+        self.num_indexed = num_rows if index is not None else None
+        if index is None:
+            rows = self.con.execute('SELECT shard, offset, size FROM records ORDER BY idx').fetchall()
+            index = np.array(rows, dtype=INDEX_DTYPE)
+        self.num_items = len(index)
+        self.num_committed = len(index)
+        if self.read_only and len(index) > 0:
+            if self.num_indexed is None:
+                self.index = index
+                self._save_index()
+            self.index = np.load(self.index_file, mmap_mode='r')
+            return
+        # Grown by doubling as items are added.
+        self.index = np.empty(max(len(index), 1024), dtype=INDEX_DTYPE)
+        self.index[:len(index)] = index
+
+
+    def _save_index(self):
+        tmp_path = self.path / 'index.npy.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.index[:self.num_committed])
+        os.replace(tmp_path, self.index_file)
+        self.con.execute('DELETE FROM index_file')
+        self.con.execute('INSERT INTO index_file VALUES(?)', (self.num_committed,))
+        self.con.commit()
+        self.num_indexed = self.num_committed
+
+
+    def _recover_shards(self):
+        # Shard bytes are written and synced to disk before their index rows are committed. After a crash, a shard can
+        # have a tail of records that never made it into the index, or be an orphan that isn't referenced at all.
+        # Truncate or delete those so the files match the committed index. Shards written by older versions weren't
+        # synced, so after an OS crash or power loss the index can also point past the end of a shard, or at a missing
+        # one. Those items are dropped from the index, to be cached again.
+        self._drop_lost_records()
+        committed = self.index[:self.num_items]
+        shard_ends = {}
+        for shard_id in np.unique(committed['shard']).tolist():
+            rows = committed[committed['shard'] == shard_id]
+            shard_ends[shard_id] = int((rows['offset'] + rows['size']).max())
+        for bin_path in self.path.glob('shard_*.bin'):
+            shard_id = int(bin_path.stem.split('_')[-1])
+            if shard_id not in shard_ends:
+                print(f'[CACHE] Removing unreferenced shard {bin_path.name}')
+                os.remove(bin_path)
+                # the next shard with this id may use a different codec
+                self.con.execute('DELETE FROM shards WHERE shard = ?', (shard_id,))
+                self.con.commit()
+                self.shard_codecs.pop(shard_id, None)
+            elif os.path.getsize(bin_path) > shard_ends[shard_id]:
+                print(f'[CACHE] Truncating partially written shard {bin_path.name} to {shard_ends[shard_id]} bytes')
+                os.truncate(bin_path, shard_ends[shard_id])
+
+
+    def _drop_lost_records(self):
+        # Items whose records aren't all in their shard file.
+        committed = self.index[:self.num_items]
+        shard_sizes = {}
+        for shard_id in np.unique(committed['shard']).tolist():
+            bin_path = self.path / f'shard_{shard_id}.bin'
+            shard_sizes[shard_id] = os.path.getsize(bin_path) if bin_path.exists() else 0
+        sizes = np.array([shard_sizes[shard_id] for shard_id in committed['shard'].tolist()], dtype=np.int64)
+        lost = committed['offset'].astype(np.int64) + committed['size'] > sizes
+        if not lost.any():
+            return
+        rows = self.con.execute('SELECT shard, offset, size, key FROM records ORDER BY idx').fetchall()
+        if all(row[3] is not None for row in rows):
+            # Items are found by key, the rest stay where they are.
+            keep = ~lost
+        else:
+            # Items without keys are matched to dataset rows by position, keep the ones before the first lost item.
+            keep = np.arange(len(rows)) < np.argmax(lost)
+        print(f'[CACHE] {int(lost.sum())} items point past the end of their shard files, dropping {len(rows) - int(keep.sum())} items from the index to cache them again')
+        rows = [(i,) + row for i, row in enumerate(row for row, k in zip(rows, keep.tolist()) if k)]
+        self.con.execute('DELETE FROM records')
+        self.con.executemany('INSERT INTO records VALUES(?, ?, ?, ?, ?)', rows)
+        self.con.execute('DELETE FROM index_file')
         self.con.commit()
+        self.index[:len(rows)] = np.array([row[1:4] for row in rows], dtype=INDEX_DTYPE)
+        self.num_items = self.num_committed = len(rows)
+        self.num_indexed = None
 
 
     def clear(self):
         '''Deletes all cache files from disk. Calls init() again.'''
         self.con.close()
+        self.open_files = {}
         os.remove(self.metadata_db)
+        if self.index_file.exists():
+            os.remove(self.index_file)
         for bin_path in self.path.glob('*.bin'):
             os.remove(bin_path)
         self.init()
 
 
+    def migrate(self, old_format_version):
+        '''Rewrites all existing shards in self.format_version. Each shard is copied to a new shard id and the index is
+        switched over in a single transaction, so an interruption leaves either the old or the new shard in use.'''
+        print(f'[CACHE] Migrating cache from format version {old_format_version} to {self.format_version}')
+        for old_shard in np.unique(self.index['shard'][:self.num_items]).tolist():
+            new_shard = self._rewrite_shard(old_shard, reencode=True)
+            print(f'[CACHE] Migrated shard_{old_shard} -> shard_{new_shard}')
+        self._save_index()
+
+
+    def _rewrite_shard(self, old_shard, reencode):
+        '''Copies the records of old_shard that are still referenced to a new shard, and removes old_shard. With reencode,
+        records are converted to the current format and codec, otherwise their bytes are copied as they are.'''
+        index = self.index[:self.num_items]
+        new_shard = self.shard
+        self.shard += 1
+        item_indices = np.nonzero(index['shard'] == old_shard)[0]
+        old_codec = self.shard_codecs.get(old_shard, (None, False))
+        rows = []
+        # several items can share one record, copy it once
+        new_locations = {}
+        offset = 0
+        with open(self.path / f'shard_{old_shard}.bin', 'rb') as old_f, open(self.path / f'shard_{new_shard}.bin', 'wb') as f:
+            for i in item_indices.tolist():
+                _, old_offset, old_size = index[i].tolist()
+                if old_offset not in new_locations:
+                    old_f.seek(old_offset)
+                    buffer = bytearray(old_size)
+                    old_f.readinto(buffer)
+                    if reencode:
+                        item = decode_record(buffer, 0, old_size, *old_codec)
+                        buffers = encode_item(item, self.format_version, self.compression, self.byte_shuffle)
+                    else:
+                        buffers = [buffer]
+                    size = 0
+                    for x in buffers:
+                        size += f.write(x)
+                    new_locations[old_offset] = (offset, size)
+                    offset += size
+                rows.append((new_shard,) + new_locations[old_offset] + (i,))
+            f.flush()
+            os.fsync(f.fileno())
+        self.con.executemany('UPDATE records SET shard = ?, offset = ?, size = ? WHERE idx = ?', rows)
+        self._add_shard_codec(new_shard, None if reencode else old_codec)
+        self.con.execute('DELETE FROM shards WHERE shard = ?', (old_shard,))
+        self.shard_codecs.pop(old_shard, None)
+        # index sidecar is stale until rewritten
+        self.con.execute('DELETE FROM index_file')
+        self.con.commit()
+        os.remove(self.path / f'shard_{old_shard}.bin')
+        for new_shard, offset, size, i in rows:
+            index[i] = (new_shard, offset, size)
+        return new_shard
+
+
+    def _add_shard_codec(self, shard_id, codec=None):
+        if codec is None:
+            codec = (self.compression, self.byte_shuffle and self.compression is not None)
+        self.con.execute('INSERT OR REPLACE INTO shards VALUES(?, ?, ?)', (shard_id,) + codec)
+        self.shard_codecs[shard_id] = codec
+
+
     def create_new_shard(self):
         self.shard_file = open(self.path / f'shard_{self.shard}.bin', 'wb')
-        self.shard_table = f'shard_{self.shard}'
-        print(f'[CACHE] Creating new shard: {self.shard_table}')
-        self.con.execute(f'CREATE TABLE {self.shard_table}(offset, size)')
-        self.shard_index = 0
+        print(f'[CACHE] Creating new shard: shard_{self.shard}' + (f' (compression: {self.compression})' if self.compression else ''))
+        # committed together with the first batch of index rows
+        self._add_shard_codec(self.shard)
         self.offset = 0
 
 
-    def finalize_current_shard(self):
-        if self.shard_file is None:
-            # no-op if already finalized
+    def flush(self):
+        '''Writes buffered index rows to the database in one transaction.'''
+        if len(self.pending) == 0:
             return
-        self.shard_file.close()
-        self.shard_file = None
-        self.shard += 1
+        # Make sure the records are on disk before the index rows pointing at them are committed, so they still match
+        # after an OS crash or power loss.
+        if self.shard_file is not None:
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+        self.con.executemany('INSERT INTO records VALUES(?, ?, ?, ?, ?)', self.pending)
         self.con.commit()
+        self.num_committed += len(self.pending)
+        self.pending = []
+
+
+    def finalize_current_shard(self):
+        self.flush()
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+            self.shard += 1
+        if self.num_indexed != self.num_committed:
+            self._save_index()
 
 
-    def add(self, item):
+    def _append_entry(self, entry, key=None):
+        if self.num_items == len(self.index):
+            self.index = np.resize(self.index, 2 * len(self.index))
+        self.index[self.num_items] = entry
+        self.pending.append((self.num_items,) + entry + (key,))
+        self.num_items += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+
+    def add(self, item, key=None):
+        assert not self.read_only
         if self.shard_file is None:
             self.create_new_shard()
-        buffer = io.BytesIO()
-        torch.save(item, buffer)
-        bytes_view = buffer.getbuffer()
-        self.shard_file.write(bytes_view)
-
-        # update items metadata
-        item = (self.shard, self.shard_index)
-        self.items.append(item)
-        self.con.execute('INSERT INTO items VALUES(?, ?)', item)
-        self.shard_index += 1
-
-        # update shard metadata
-        size = len(bytes_view)
-        entry = (self.offset, size)
-        self.shard_metadata[self.shard].append(entry)
-        self.con.execute(f'INSERT INTO {self.shard_table} VALUES (?, ?)', entry)
+        size = 0
+        for buffer in encode_item(item, self.format_version, self.compression, self.byte_shuffle):
+            size += self.shard_file.write(buffer)
+
+        # update index
+        self._append_entry((self.shard, self.offset, size), key)
         self.offset += size
 
         # create new shard when existing one is large enough
-        current_size_gb = self.shard_file.tell() / 1_000_000_000
+        current_size_gb = self.offset / 1_000_000_000
         if current_size_gb >= self.shard_size_gb:
             self.finalize_current_shard()
 
 
+    def get_writer_args(self, num_writers):
+        '''Arguments for ShardWriter. Writer i of num_writers uses shard ids self.shard + i + k*num_writers, so
+        writers never need to coordinate. Nothing else may write to this cache until their entries are added.'''
+        return {
+            'path': self.path,
+            'first_shard': self.shard,
+            'shard_stride': num_writers,
+            'shard_size_gb': self.shard_size_gb,
+            'format_version': self.format_version,
+            'compression': self.compression,
+            'byte_shuffle': self.byte_shuffle,
+        }
+
+
+    def add_written(self, entry, key=None):
+        '''Appends an item that a ShardWriter already wrote. entry is the (shard, offset, size) it returned.
+        The writer must have flushed the shard file before this is called.'''
+        shard_id = entry[0]
+        if shard_id not in self.shard_codecs:
+            self._add_shard_codec(shard_id)
+        self.shard = max(self.shard, shard_id + 1)
+        self._append_entry(tuple(entry), key)
+
+
+    def get_keys(self):
+        '''Keys of all committed items, in item order. None for items added without a key.'''
+        return [key for key, in self.con.execute('SELECT key FROM records ORDER BY idx').fetchall()]
+
+
+    def set_keys(self, keys):
+        '''Assigns keys to the first len(keys) items.'''
+        self.con.executemany('UPDATE records SET key = ? WHERE idx = ?', [(key, i) for i, key in enumerate(keys)])
+        self.con.commit()
+
+
+    def set_order(self, keys, min_live_fraction=0.5):
+        '''Rewrites the index so item i is the record stored under keys[i]. Every key must already be in the cache, and
+        a key can be used more than once. Records whose key isn't in keys are dropped, and shards where less than
+        min_live_fraction of the bytes are still referenced are compacted.'''
+        self.finalize_current_shard()
+        if self.get_keys() == keys:
+            return
+        locations = {}
+        for key, shard_id, offset, size in self.con.execute('SELECT key, shard, offset, size FROM records').fetchall():
+            locations[key] = (shard_id, offset, size)
+        rows = [(i,) + locations[key] + (key,) for i, key in enumerate(keys)]
+        self.con.execute('DELETE FROM records')
+        self.con.executemany('INSERT INTO records VALUES(?, ?, ?, ?, ?)', rows)
+        self.con.execute('DELETE FROM index_file')
+        self.con.commit()
+        index = np.array([row[1:4] for row in rows], dtype=INDEX_DTYPE)
+        self.index = np.empty(max(len(index), 1024), dtype=INDEX_DTYPE)
+        self.index[:len(index)] = index
+        self.num_items = self.num_committed = len(index)
+        self.open_files = {}
+
+        index = self.index[:self.num_items]
+        referenced_shards = set(np.unique(index['shard']).tolist())
+        for shard_id in list(self.shard_codecs):
+            if shard_id not in referenced_shards:
+                print(f'[CACHE] Removing unreferenced shard shard_{shard_id}')
+                self.con.execute('DELETE FROM shards WHERE shard = ?', (shard_id,))
+                self.con.commit()
+                self.shard_codecs.pop(shard_id)
+                bin_path = self.path / f'shard_{shard_id}.bin'
+                if bin_path.exists():
+                    os.remove(bin_path)
+        for shard_id in sorted(referenced_shards):
+            shard_rows = index[index['shard'] == shard_id]
+            _, first = np.unique(shard_rows['offset'], return_index=True)
+            live_bytes = int(shard_rows['size'][first].sum())
+            total_bytes = os.path.getsize(self.path / f'shard_{shard_id}.bin')
+            if live_bytes < min_live_fraction * total_bytes:
+                new_shard = self._rewrite_shard(shard_id, reencode=False)
+                print(f'[CACHE] Compacted shard_{shard_id} -> shard_{new_shard}, {(total_bytes - live_bytes) / 1e6:.1f} MB freed')
+        self._save_index()
+
+
+class ShardWriter:
+    '''Encodes and writes records to shard files of its own, so multiple worker processes can populate one Cache
+    in parallel. The parent process adds the returned entries to the Cache in whatever order it wants the items in.'''
+    def __init__(self, path, first_shard, shard_stride, shard_size_gb, format_version, compression, byte_shuffle, rank=0):
+        self.path = Path(path)
+        self.shard = first_shard + rank
+        self.shard_stride = shard_stride
+        self.shard_size_gb = shard_size_gb
+        self.format_version = format_version
+        self.compression = compression
+        self.byte_shuffle = byte_shuffle
+        self.shard_file = None
+        self.offset = 0
+
+
+    def write(self, item):
+        if self.shard_file is None:
+            self.shard_file = open(self.path / f'shard_{self.shard}.bin', 'wb')
+            self.offset = 0
+        size = 0
+        for buffer in encode_item(item, self.format_version, self.compression, self.byte_shuffle):
+            size += self.shard_file.write(buffer)
+        entry = (self.shard, self.offset, size)
+        self.offset += size
+        if self.offset / 1_000_000_000 >= self.shard_size_gb:
+            self.close()
+            self.shard += self.shard_stride
+        return entry
+
+
+    def flush(self):
+        '''Writes the records to disk. Cache.add_written() must only be called for entries that have been flushed.'''
+        if self.shard_file is not None:
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+
+
+    def close(self):
+        if self.shard_file is not None:
+            self.flush()
+            self.shard_file.close()
+            self.shard_file = None
+
+
 # for testing
 if __name__ == '__main__':
     cache = Cache('/home/anon/tmp/cache_test', 'foo', shard_size_gb=0.001)
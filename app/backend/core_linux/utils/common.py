@@ -5,6 +5,7 @@ import math
 from pathlib import Path
 import os
 
+import psutil
 import torch
 import deepspeed.comm.comm as dist
 import imageio
@@ -65,6 +66,12 @@ def log_duration(name):
         print(f'{name}: {time.time()-start:.3f}')
 
 
+def log_memory_usage(name):
+    # USS is memory only this process uses. RSS also counts pages shared with other processes, e.g. memory mapped files.
+    info = psutil.Process().memory_full_info()
+    print(f'rank {get_rank()} memory {name}: RSS {info.rss/1e9:.2f} GB, USS {info.uss/1e9:.2f} GB')
+
+
 def load_safetensors(path):
     tensors = {}
     with safe_open(path, framework="pt", device="cpu") as f:
@@ -1,14 +1,22 @@
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import os.path
 import random
-from collections import defaultdict
+from collections import defaultdict, deque
 import math
 import os
 import hashlib
 import json
+import shutil
 import tarfile
+import io
 from inspect import signature
 import sys
+import sqlite3
+import contextlib
+import threading
+import queue
+import time
+import itertools
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '../submodules/ComfyUI'))
 
 import numpy as np
@@ -18,13 +26,16 @@ from deepspeed.utils.logging import logger
 from deepspeed import comm as dist
 import datasets
 from datasets.fingerprint import Hasher
+import pyarrow as pa
+import pyarrow.compute as pc
 from PIL import Image
-import imageio
+import av
 import multiprocess as mp
 from tqdm import tqdm
 
-from utils.common import is_main_process, VIDEO_EXTENSIONS, round_to_nearest_multiple
-from utils.cache import Cache
+from utils.common import is_main_process, zero_first, log_memory_usage, VIDEO_EXTENSIONS, round_to_nearest_multiple
+from utils.cache import Cache, ShardWriter, LATEST_FORMAT_VERSION
+from utils.task_channel import TaskServer, TaskClient
 import comfy.model_management as mm
 
 
@@ -33,10 +44,50 @@ IMAGE_SIZE_ROUND_TO_MULTIPLE = 32
 NUM_PROC = min(8, os.cpu_count())
 CAPTIONS_JSON_FILE = 'captions.json'
 ROUND_DECIMAL_DIGITS = 3
+# On-disk record format for newly written cache items. Existing caches are migrated to it.
+CACHE_FORMAT_VERSION = LATEST_FORMAT_VERSION
+# Encode captions for the text embedding cache in order of length, so batches need less padding.
+SORT_CAPTIONS_BY_LENGTH = False
+# Files probed per call of the metadata map function in each worker.
+METADATA_BATCH_SIZE = 256
+# Buffer size for reading tar files sequentially with tar_streaming.
+TAR_READ_BUFFER_SIZE = 16 * 1024 * 1024
+# When loading from cache, the main process writes the cache and text embedding indexes to files that every process
+# (other ranks and their DataLoader workers) memory maps read-only, instead of each building a private copy.
+SHARED_INDEXES = False
 
 UNCOND_FRACTION = 0.0
 
 
+def probe_media_file(filepath_or_file, suffix, framerate=None):
+    '''Returns (width, height, frames) of an image or video, reading only the image header or container metadata.
+    The frame count of a video is estimated from its duration.'''
+    if suffix in VIDEO_EXTENSIONS:
+        assert framerate is not None, "Need model framerate but don't have it. This shouldn't happen. Is the framerate attribute on the model set?"
+        with av.open(filepath_or_file) as container:
+            stream = container.streams.video[0]
+            width, height = stream.codec_context.width, stream.codec_context.height
+            # Container duration is what imageio reports, the stream duration isn't always set.
+            if container.duration is not None:
+                duration = container.duration / av.time_base
+            elif stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                raise ValueError('video has no duration in its metadata')
+        # TODO: this is an estimate of frame count. What happens if variable frame rate? Is
+        # it still close enough?
+        return width, height, int(framerate * duration)
+    with Image.open(filepath_or_file) as pil_img:
+        width, height = pil_img.size
+        frames = getattr(pil_img, 'n_frames', 1)
+    if frames > 1:
+        if suffix == '.webp':
+            raise NotImplementedError('WebP videos are not supported.')
+        # e.g. animated GIF, only the first frame is used
+        frames = 1
+    return width, height, frames
+
+
 def shuffle_with_seed(l, seed=None):
     rng_state = random.getstate()
     random.seed(seed)
@@ -70,6 +121,23 @@ def bucket_suffix(key):
         raise RuntimeError(f'Unexpected bucket: {key}')
 
 
+def repeat_list_array(values, n, type):
+    '''Arrow list array with n copies of the list values.'''
+    values = np.asarray(values)
+    offsets = np.arange(n + 1, dtype=np.int32) * len(values)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(np.tile(values, n), type=type))
+
+
+def string_array_to_numpy(strings):
+    '''Returns the UTF-8 bytes of an Arrow string array as one uint8 buffer, and the int64 offsets of the strings in it.'''
+    strings = strings.cast(pa.large_string())
+    if isinstance(strings, pa.ChunkedArray):
+        strings = strings.combine_chunks()
+    offsets = np.frombuffer(strings.buffers()[1], dtype=np.int64)[strings.offset:strings.offset+len(strings)+1]
+    data = np.frombuffer(strings.buffers()[2], dtype=np.uint8) if len(strings) > 0 else np.zeros(0, dtype=np.uint8)
+    return data[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+
 def dedup_and_sort(values):
     values = set(round(x, ROUND_DECIMAL_DIGITS) for x in values)
     values = list(values)
@@ -77,49 +145,322 @@ def dedup_and_sort(values):
     return np.array(values)
 
 
-def _map_and_cache(dataset, map_fn, cache_dir, cache_file_prefix='', new_fingerprint_args=None, regenerate_cache=False, caching_batch_size=1):
-    new_fingerprint_args = [] if new_fingerprint_args is None else new_fingerprint_args
-    new_fingerprint_args.append(dataset._fingerprint)
-    new_fingerprint = Hasher.hash(new_fingerprint_args)
-    if cache_file_prefix:
-        cache_dir = cache_dir / cache_file_prefix.strip('_')
+class FileSignatures:
+    '''Identifies the contents of the files a dataset row refers to, so cached items can be keyed by what they were
+    computed from. By default a file's signature is its size and mtime. With full_hash, the file contents are hashed,
+    and the digests are stored in db_path by size and mtime so unchanged files are only read once.'''
 
-    cache = Cache(cache_dir, new_fingerprint, shard_size_gb=10)
+    # columns that name media, mask and control files
+    FILE_COLUMNS = ('image_spec', 'mask_file', 'control_file')
 
-    if map_fn is None:
-        # loading directly from cache without mapping
-        assert new_fingerprint == cache.fingerprint
-        return cache
+    def __init__(self, db_path, full_hash=False):
+        self.db_path = Path(db_path)
+        self.full_hash = full_hash
+        self.con = None
+        # sqlite connections can only be used by the thread that opened them
+        self.con_thread = None
+        self.signatures = {}
 
-    if regenerate_cache:
-        cache.clear()
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['con'] = None
+        state['con_thread'] = None
+        return state
 
-    # Cache has either been cleared if fingerprint didn't match, or has some (maybe 0) existing items in it.
+    def __call__(self, path):
+        if path is None or path == '':
+            return None
+        path = str(path)
+        if path not in self.signatures:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return None
+            signature = f'{st.st_size}:{st.st_mtime_ns}'
+            if self.full_hash:
+                signature = self._digest(path, signature)
+            self.signatures[path] = signature
+        return self.signatures[path]
+
+    def _digest(self, path, stat_signature):
+        if self.con is None or self.con_thread != threading.get_ident():
+            # When caching runs in a thread (NUM_PROC == 1 on Windows), the connection it opened can't be used for
+            # loading. content_keys() has committed everything written through it.
+            os.makedirs(self.db_path.parent, exist_ok=True)
+            self.con = sqlite3.connect(self.db_path, autocommit=False)
+            self.con_thread = threading.get_ident()
+            self.con.execute('CREATE TABLE IF NOT EXISTS digests(path TEXT PRIMARY KEY, stat, digest)')
+        row = self.con.execute('SELECT stat, digest FROM digests WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat_signature:
+            return row[1]
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.con.execute('INSERT OR REPLACE INTO digests VALUES(?, ?, ?)', (path, stat_signature, digest))
+        return digest
+
+    def content_keys(self, dataset, columns, file_columns=FILE_COLUMNS):
+        '''One key per row of dataset, from the values in columns and the signatures of the files in file_columns.
+        Files inside a tar are identified by the tar file and the member name.'''
+        columns = [c for c in columns if c in dataset.column_names]
+        file_columns = [c for c in file_columns if c in dataset.column_names]
+        keys = []
+        for example in dataset.select_columns(list(dict.fromkeys(columns + file_columns))):
+            files = []
+            for c in file_columns:
+                value = example[c]
+                if c == 'image_spec':
+                    files.append(value[0] if value[0] is not None else value[1])
+                elif isinstance(value, list):
+                    files.extend(value)
+                else:
+                    files.append(value)
+            parts = [example[c] for c in columns] + [self(f) for f in files]
+            keys.append(hashlib.md5(json.dumps(parts).encode()).hexdigest())
+        if self.con is not None and self.con_thread == threading.get_ident():
+            self.con.commit()
+        return keys
+
+
+class DirectoryListing:
+    '''Persistent index of the files in some directories, with the size and mtime of each file and what was read from
+    it (image or video size, caption text, tar members). A rescan lists each directory with os.scandir and compares the
+    stats against the index, so only new or changed files have to be read again.'''
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        os.makedirs(self.db_path.parent, exist_ok=True)
+        self.con = sqlite3.connect(self.db_path, autocommit=False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS files(directory TEXT, name TEXT, size, mtime_ns, info, PRIMARY KEY(directory, name))')
+
+    def clear(self):
+        self.con.execute('DELETE FROM files')
+
+    def scan(self, directory):
+        '''Returns {name: (size, mtime_ns)} of the regular files in directory, sorted by name. Files that were removed
+        are dropped from the index, and what was read from files that changed is forgotten.'''
+        directory = str(directory)
+        stats = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    stats[entry.name] = (st.st_size, st.st_mtime_ns)
+        indexed = {
+            name: (size, mtime_ns)
+            for name, size, mtime_ns in self.con.execute('SELECT name, size, mtime_ns FROM files WHERE directory = ?', (directory,))
+        }
+        removed = [(directory, name) for name in indexed.keys() - stats.keys()]
+        changed = [(directory, name, *stat) for name, stat in stats.items() if indexed.get(name) != stat]
+        self.con.executemany('DELETE FROM files WHERE directory = ? AND name = ?', removed)
+        self.con.executemany('INSERT OR REPLACE INTO files VALUES(?, ?, ?, ?, NULL)', changed)
+        return dict(sorted(stats.items()))
+
+    def get_info(self, directory):
+        '''Returns {name: info} for the files in directory that have been read since they last changed.'''
+        rows = self.con.execute('SELECT name, info FROM files WHERE directory = ? AND info IS NOT NULL', (str(directory),))
+        return {name: json.loads(info) for name, info in rows}
+
+    def set_info(self, directory, infos):
+        self.con.executemany(
+            'UPDATE files SET info = ? WHERE directory = ? AND name = ?',
+            [(json.dumps(info), str(directory), name) for name, info in infos.items()]
+        )
 
-    # Skip existing items
-    cache_size = len(cache)
-    dataset_size = len(dataset)
-    assert cache_size <= dataset_size
-    if cache_size == dataset_size:
-        return cache
-    dataset = dataset.select(range(cache_size, dataset_size), keep_in_memory=True)
+    def commit(self):
+        self.con.commit()
 
-    # Let each worker process know its rank
-    manager = mp.Manager()
-    id_queue = manager.Queue()
 
-    def init(queue):
-        global rank
-        rank = queue.get()
+def _read_media_info(filepath_or_file, name, framerate):
+    try:
+        return list(probe_media_file(filepath_or_file, Path(name).suffix, framerate))
+    except NotImplementedError:
+        raise
+    except Exception as e:
+        return {'error': str(e)}
+    finally:
+        if hasattr(filepath_or_file, 'close'):
+            filepath_or_file.close()
 
-    for i in range(NUM_PROC):
-        id_queue.put(i)
 
-    pool = mp.Pool(NUM_PROC, init, (id_queue,))
+def _open_tar_stream(path):
+    # For reading the members of a tar file in the order they are stored, so the file is read front to back in large
+    # chunks. Files that aren't needed are skipped by seeking forward. (Stream mode, 'r|', copies its whole buffer on
+    # every read, so it can't use a large buffer.)
+    f = open(path, 'rb', buffering=TAR_READ_BUFFER_SIZE)
+    return tarfile.TarFile(fileobj=f), f
 
-    def wrapper(example):
-        global rank
-        return map_fn(example, rank)
+
+def _read_tar_info(path, framerate, stream):
+    # One pass over the members of a tar file. .txt members are captions for the media file with the same name
+    # (WebDataset style). With stream, the tar file is read sequentially, including the media files themselves.
+    if stream:
+        tar_f, f = _open_tar_stream(path)
+    else:
+        tar_f, f = tarfile.TarFile(path), None
+    members = []
+    media = {}
+    captions = {}
+    try:
+        for member in tar_f:
+            if not member.isfile():
+                continue
+            file = tar_f.extractfile(member)
+            if Path(member.name).suffix == '.txt':
+                captions[member.name] = file.read().decode().strip()
+                continue
+            members.append(member.name)
+            # probe a copy, so the file is only read forwards
+            media[member.name] = _read_media_info(io.BytesIO(file.read()) if stream else file, member.name, framerate)
+    finally:
+        tar_f.close()
+        if f is not None:
+            f.close()
+    return {'members': members, 'media': media, 'captions': captions}
+
+
+def _read_listing_info(task):
+    # What the metadata needs from one file of a DirectoryListing: the caption text, the media size, or the members of
+    # a tar file with their media sizes and captions. Unreadable media are recorded as {'error': message}.
+    path, kind, framerate = task
+    if kind == 'caption':
+        with open(path) as f:
+            return f.read().strip()
+    if kind in ('tar', 'tar_stream'):
+        return _read_tar_info(path, framerate, stream=(kind == 'tar_stream'))
+    return _read_media_info(path, path, framerate)
+
+
+def _iter_batches_in_tar_order(dataset, batch_size, order):
+    '''Batches of the dataset, with the media of rows from tar files read by streaming through each tar file once.
+    Rows not in a tar file come first, then the rows of each tar file in the order they are stored in it. The file
+    bytes are in the media_bytes column (None for rows not in a tar file). The dataset position of each yielded row
+    is appended to order.'''
+    tar_rows = defaultdict(lambda: defaultdict(list))
+    positions = []
+    for position, (tar_file, name) in enumerate(dataset['image_spec']):
+        if tar_file is None:
+            positions.append(position)
+        else:
+            tar_rows[tar_file][name].append(position)
+    media_bytes = [None] * len(positions)
+
+    def batches(final=False):
+        nonlocal positions, media_bytes
+        while len(positions) >= batch_size or (final and len(positions) > 0):
+            batch = dataset[positions[:batch_size]]
+            batch['media_bytes'] = media_bytes[:batch_size]
+            order.extend(positions[:batch_size])
+            positions, media_bytes = positions[batch_size:], media_bytes[batch_size:]
+            yield batch
+
+    yield from batches()
+    for tar_file, rows in sorted(tar_rows.items()):
+        tar_f, f = _open_tar_stream(tar_file)
+        try:
+            for member in tar_f:
+                if member.name not in rows:
+                    continue
+                data = tar_f.extractfile(member).read()
+                for position in rows.pop(member.name):
+                    positions.append(position)
+                    media_bytes.append(data)
+                yield from batches()
+        finally:
+            tar_f.close()
+            f.close()
+        if len(rows) > 0:
+            raise RuntimeError(f'{len(rows)} files are missing from {tar_file}, e.g. {next(iter(rows))}. Try --regenerate_cache.')
+    yield from batches(final=True)
+
+
+def _bounded(batches, in_flight):
+    # Acquires in_flight before each batch, to bound how far ahead of the consumer batches are read and decoded.
+    for batch in batches:
+        in_flight.acquire()
+        yield batch
+
+
+def _rows(batch):
+    # A batch of dataset rows (dict of columns) as a list of rows.
+    return [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+
+
+class _CacheWriter:
+    '''Writes items with a ShardWriter in a background thread, while the next batches are being encoded. The thread
+    calling put() and close() gets the written entries, through add_written(entry, position) with the position passed
+    to put() for each item. That's where they're added to the Cache, since its database connection belongs to it.'''
+
+    def __init__(self, shard_writer, add_written, max_pending):
+        self.shard_writer = shard_writer
+        self.add_written = add_written
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.written = queue.Queue()
+        self.busy_time = 0.0
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        failed = False
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                break
+            if failed:
+                # keep taking batches, so put() doesn't block
+                continue
+            items, positions = batch
+            start = time.perf_counter()
+            try:
+                entries = [self.shard_writer.write(item) for item in items]
+                # the entries are committed once added, so the bytes must be on disk first
+                self.shard_writer.flush()
+            except Exception as e:
+                failed = True
+                self.written.put(e)
+                continue
+            self.busy_time += time.perf_counter() - start
+            self.written.put((entries, positions))
+        self.shard_writer.close()
+
+    def _add_written(self):
+        while True:
+            try:
+                batch = self.written.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for entry, position in zip(*batch):
+                self.add_written(entry, position)
+
+    def put(self, items, positions):
+        '''Queues items to be written, waiting if max_pending batches are already queued.'''
+        self.pending.put((items, positions))
+        self._add_written()
+
+    def close(self):
+        '''Waits for everything queued to be written and added to the cache.'''
+        self.pending.put(None)
+        self.thread.join()
+        self._add_written()
+
+
+def _content_keys_fingerprint(new_fingerprint_args):
+    return Hasher.hash(new_fingerprint_args + ['content_keys'])
+
+
+def _cache_rows(dataset, map_fn, writer, caching_batch_size, stream_tar_files=False, one_item_per_row=False, initial_batches=0, total_batches=None, show_progress=True, name='Cached'):
+    '''Maps the rows of dataset with map_fn (a _CachingMapFn) and puts the items to writer, a _CacheWriter that it
+    closes. With one_item_per_row, each item is put with the position of its row in dataset, otherwise with None.
+    Streaming tar files needs that, because the rows are then mapped in tar order instead of dataset order.'''
+    assert not stream_tar_files or one_item_per_row
+    # Caching is a pipeline of three stages that run at the same time: map workers decode batches of rows into items
+    # (skipped for text, the rows are the items), the TaskServers encode them caching_batch_size items at a time, and
+    # a writer thread writes the results to the shard files. Items are encoded and written in the order they are
+    # decoded, which is the dataset order unless streaming tar files.
 
     # Tensor slices reference the entire memory of the original tensor, and everything would be pickled and stored
     # in cache, so we do this.
@@ -135,42 +476,322 @@ def _map_and_cache(dataset, map_fn, cache_dir, cache_file_prefix='', new_fingerp
         else:
             return obj
 
-    def unbatch_iter(batch):
-        length = len(next(iter(batch.values())))
-        for i in range(length):
-            result = {}
-            for key in batch:
-                result[key] = batch[key][i]
-            yield recursive_clone_tensors(result)
+    def decode(example):
+        start = time.perf_counter()
+        if map_fn.decode is None:
+            items = _rows(example)
+        else:
+            items = map_fn.decode(example)
+        return items, len(next(iter(example.values()))), time.perf_counter() - start
+
+    if stream_tar_files:
+        # dataset positions in the order they're mapped
+        order = []
+        batches = _iter_batches_in_tar_order(dataset, caching_batch_size, order)
+    else:
+        order = None
+        batches = dataset.iter(batch_size=caching_batch_size)
+    decode_ahead = threading.Semaphore(4 * NUM_PROC)
+    batches = _bounded(batches, decode_ahead)
+    if map_fn.decode is None:
+        pool = None
+        decoded_iter = map(decode, batches)
+    else:
+        pool = mp.Pool(NUM_PROC)
+        decoded_iter = pool.imap(decode, batches)
+
+    client = map_fn.client
+    in_flight = deque()  # (request id, items, positions) of batches being encoded
+    items = []  # decoded, waiting to be encoded
+    item_positions = []
+    start_time = time.perf_counter()
+    start_busy_time = client.busy_time
+    decode_time = 0.0
+
+    def receive():
+        request_id, batch_items, positions = in_flight.popleft()
+        results = map_fn.result(request_id, batch_items)
+        writer.put([recursive_clone_tensors(result) for result in results], positions)
+
+    def submit(n):
+        nonlocal items, item_positions
+        if len(in_flight) == client.max_in_flight:
+            receive()
+        in_flight.append((map_fn.submit(items[:n]), items[:n], item_positions[:n]))
+        items, item_positions = items[n:], item_positions[n:]
+
+    num_rows = 0
+    for decoded, batch_rows, seconds in tqdm(decoded_iter, initial=initial_batches, total=total_batches, disable=not show_progress):
+        decode_ahead.release()
+        decode_time += seconds
+        if one_item_per_row:
+            assert len(decoded) == batch_rows, 'Caching by content key needs exactly one item per row'
+            positions = range(num_rows, num_rows + batch_rows) if order is None else order[num_rows:num_rows + batch_rows]
+            item_positions.extend(positions)
+        else:
+            item_positions.extend([None] * len(decoded))
+        num_rows += batch_rows
+        items.extend(decoded)
+        while len(items) >= caching_batch_size:
+            submit(caching_batch_size)
+    if len(items) > 0:
+        submit(len(items))
+    while len(in_flight) > 0:
+        receive()
+    writer.close()
+
+    elapsed = time.perf_counter() - start_time
+    num_servers = len(client.addresses)
+    utilization = []
+    if map_fn.decode is not None:
+        utilization.append(f'decode {decode_time / (NUM_PROC * elapsed):.0%} of {NUM_PROC} workers')
+    utilization.append(f'encode {(client.busy_time - start_busy_time) / (num_servers * elapsed):.0%} of {num_servers} GPUs')
+    utilization.append(f'write {writer.busy_time / elapsed:.0%}')
+    print(f'{name} {num_rows} rows in {elapsed:.1f}s, busy: ' + ', '.join(utilization))
+
+    if pool is not None:
+        pool.close()
+
+
+def _map_and_cache(dataset, map_fn, cache_dir, cache_file_prefix='', new_fingerprint_args=None, regenerate_cache=False, caching_batch_size=1, compression=None, byte_shuffle=False, content_keys=None, stream_tar_files=False):
+    new_fingerprint_args = [] if new_fingerprint_args is None else new_fingerprint_args
+    # With content_keys, a function returning one key per dataset row, items are matched to rows by key. Only rows
+    # with new keys are mapped, so the cache doesn't depend on the dataset fingerprint. Caches from before content
+    # keys were fingerprinted with it, and are kept if the dataset hasn't changed since.
+    # With stream_tar_files, files in tar files are mapped in the order they are stored, see _iter_batches_in_tar_order().
+    # That needs content_keys, so the items can be put back in dataset order afterwards.
+    assert not stream_tar_files or content_keys is not None
+    previous_fingerprint = Hasher.hash(new_fingerprint_args + [dataset._fingerprint])
+    if content_keys is None:
+        new_fingerprint = previous_fingerprint
+        previous_fingerprint = None
+    else:
+        new_fingerprint = _content_keys_fingerprint(new_fingerprint_args)
+    if cache_file_prefix:
+        cache_dir = cache_dir / cache_file_prefix.strip('_')
+
+    # Only migrate the record format when caching. When loading directly from cache, read whatever is there.
+    format_version = CACHE_FORMAT_VERSION if map_fn is not None else None
+    cache = Cache(
+        cache_dir,
+        new_fingerprint,
+        shard_size_gb=10,
+        format_version=format_version,
+        compression=compression,
+        byte_shuffle=byte_shuffle,
+        previous_fingerprint=previous_fingerprint if map_fn is not None else None,
+        read_only=map_fn is None and SHARED_INDEXES,
+    )
+
+    if map_fn is None:
+        # loading directly from cache without mapping
+        assert new_fingerprint == cache.fingerprint
+        return cache
+
+    if regenerate_cache:
+        cache.clear()
+
+    # Cache has either been cleared if fingerprint didn't match, or has some (maybe 0) existing items in it.
+
+    dataset_size = len(dataset)
+    if content_keys is None:
+        # Skip existing items
+        cache_size = len(cache)
+        assert cache_size <= dataset_size
+        if cache_size == dataset_size:
+            return cache
+        rows = range(cache_size, dataset_size)
+        row_keys = None
+    else:
+        keys = content_keys()
+        assert len(keys) == dataset_size
+        cached_keys = cache.get_keys()
+        if len(cached_keys) > 0 and cached_keys[0] is None:
+            # kept from before content keys, in dataset order
+            cached_keys = keys[:len(cached_keys)]
+            cache.set_keys(cached_keys)
+        # Map each missing key once, even if several rows share it.
+        cached_keys = set(cached_keys)
+        rows = []
+        for i, key in enumerate(keys):
+            if key not in cached_keys:
+                cached_keys.add(key)
+                rows.append(i)
+        print(f'{dataset_size - len(rows)} of {dataset_size} items already cached')
+        row_keys = [keys[i] for i in rows]
+        cache_size = dataset_size - len(rows)
+        if len(rows) == 0:
+            cache.set_order(keys)
+            return cache
+    dataset = dataset.select(rows, keep_in_memory=True)
+
+    def add_written(entry, position):
+        cache.add_written(entry, None if row_keys is None else row_keys[position])
 
     completed_batches = cache_size // caching_batch_size
     total_batches = dataset_size // caching_batch_size
+    one_item_per_row = row_keys is not None
+    if map_fn.workers is None:
+        writer = _CacheWriter(ShardWriter(**cache.get_writer_args(1)), add_written, max_pending=map_fn.client.max_in_flight)
+        _cache_rows(dataset, map_fn, writer, caching_batch_size, stream_tar_files, one_item_per_row, completed_batches, total_batches)
+    else:
+        # Split the rows between the caching workers of all ranks. Each caches its slice to shard files of its own and
+        # sends back the entries, which are added here in the order caching everything here would have added them.
+        # Each worker gets one slice, since they're all sent before any result is received.
+        num_slices = len(map_fn.workers.addresses)
+        writer_args = cache.get_writer_args(num_slices)
+        bounds = [len(dataset) * i // num_slices for i in range(num_slices + 1)]
+        slices = []
+        for start, end in zip(bounds, bounds[1:]):
+            if end > start:
+                task = (dataset.select(range(start, end), keep_in_memory=True), writer_args, caching_batch_size, stream_tar_files, one_item_per_row)
+                slices.append((start, map_fn.workers.submit(task)))
+        for start, request_id in slices:
+            for entry, position in map_fn.workers.result(request_id):
+                add_written(entry, None if position is None else start + position)
 
-    map_iter = pool.imap(wrapper, dataset.iter(batch_size=caching_batch_size))
-    for batch in tqdm(map_iter, initial=completed_batches, total=total_batches):
-        for example in unbatch_iter(batch):
-            cache.add(example)
-
-    pool.close()
     cache.finalize_current_shard()
+    if content_keys is not None:
+        # put items in dataset order and drop the ones for rows that no longer exist
+        cache.set_order(keys)
     return cache
 
 
-class TextEmbeddingDataset:
-    def __init__(self, te_dataset, flattened_captions):
-        self.te_dataset = te_dataset
-        self.flattened_captions = flattened_captions
-        self.image_spec_to_te_idx = defaultdict(list)
-        # TODO: maybe make this use Dataset object like the latents. But, you won't be caching text embeddings
-        # when training on very large datasets, so perhaps it doesn't really matter.
-        for i, image_spec in enumerate(flattened_captions['image_spec']):
-            self.image_spec_to_te_idx[tuple(image_spec)].append(i)
+# Text embedding stores by (path, text encoder), shared by everything in this process that caches there.
+_text_embedding_stores = {}
+
+
+class TextEmbeddingStore:
+    '''Text embeddings for one text encoder, with one item per unique (caption, is_video, control file). All size
+    buckets of the directories that use the same store refer to it, so each unique caption is only encoded once.
+    Captions are collected with add() while caching, then encoded all at once by cache_added().'''
+
+    COLUMNS = ['caption', 'is_video', 'control_file']
+
+    def __init__(self, path, i, directory_config):
+        self.path = Path(path)
+        self.i = i
+        self.compression = directory_config['cache_compression']
+        self.byte_shuffle = directory_config['cache_byte_shuffle']
+        self.fingerprint_args = [i]
+        self.num_rows = 0
+        self.unique_rows = {}
+        self.cache = None
+        self.key_to_idx = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['unique_rows'] = {}
+        state['key_to_idx'] = None
+        return state
+
+    def content_keys(self, flattened_captions, file_signatures):
+        return file_signatures.content_keys(flattened_captions, self.COLUMNS, file_columns=['control_file'])
+
+    def add(self, flattened_captions, keys):
+        columns = [c for c in self.COLUMNS if c in flattened_captions.column_names]
+        for key, example in zip(keys, flattened_captions.select_columns(columns)):
+            self.num_rows += 1
+            if key not in self.unique_rows:
+                self.unique_rows[key] = example
+
+    def cache_added(self, map_fn, regenerate_cache=False, caching_batch_size=1):
+        '''Encodes the unique captions added so far that aren't cached yet. Anything else in the store is dropped.'''
+        keys = list(self.unique_rows)
+        if len(keys) == 0:
+            return
+        print(f'Text encoder {self.i}: {self.num_rows} captions, {len(keys)} unique ({1 - len(keys) / self.num_rows:.1%} duplicates)')
+        rows = list(self.unique_rows.values())
+        if caching_batch_size > 1:
+            lengths = [len(row['caption']) for row in rows]
+            print(f'Estimated text encoder padding from caption lengths, batch size {caching_batch_size}: {_padding_fraction(lengths, caching_batch_size):.1%} in dataset order, '
+                  f'{_padding_fraction(sorted(lengths), caching_batch_size):.1%} sorted by length')
+            if SORT_CAPTIONS_BY_LENGTH:
+                # Items are looked up by key, so the order they are cached in doesn't matter.
+                order = sorted(range(len(rows)), key=lambda j: lengths[j])
+                rows = [rows[j] for j in order]
+                keys = [keys[j] for j in order]
+        columns = [c for c in self.COLUMNS if any(c in row for row in rows)]
+        unique_captions = datasets.Dataset.from_dict({c: [row.get(c, None) for row in rows] for c in columns})
+        _map_and_cache(
+            unique_captions,
+            map_fn,
+            self.path,
+            cache_file_prefix=f'text_embeddings_{self.i}_',
+            new_fingerprint_args=list(self.fingerprint_args),
+            regenerate_cache=regenerate_cache,
+            caching_batch_size=caching_batch_size,
+            compression=self.compression,
+            byte_shuffle=self.byte_shuffle,
+            content_keys=lambda: keys,
+        )
+        self.num_rows = 0
+        self.unique_rows = {}
+
+    def open(self):
+        if self.cache is None:
+            self.cache = Cache(self.path / f'text_embeddings_{self.i}', _content_keys_fingerprint(list(self.fingerprint_args)), read_only=SHARED_INDEXES)
+
+    def indices(self, keys):
+        self.open()
+        if self.key_to_idx is None:
+            self.key_to_idx = {key: idx for idx, key in enumerate(self.cache.get_keys())}
+        return np.array([self.key_to_idx[key] for key in keys], dtype=np.int64)
+
+    def __getitem__(self, idx):
+        return self.cache[idx]
+
 
-    def get_text_embeddings(self, image_spec, caption_number):
-        return self.te_dataset[self.image_spec_to_te_idx[image_spec][caption_number]]
+def _padding_fraction(lengths, batch_size):
+    '''Fraction of a padded batch that is padding, if each batch is padded to its longest item.'''
+    padded = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start+batch_size]
+        padded += max(batch) * len(batch)
+    return 1 - sum(lengths) / padded if padded > 0 else 0.0
 
 
-def _cache_text_embeddings(metadata_dataset, map_fn, i, cache_dir, regenerate_cache, caching_batch_size):
+def _get_text_embedding_store(path, i, directory_config):
+    key = (str(path), i)
+    if key not in _text_embedding_stores:
+        _text_embedding_stores[key] = TextEmbeddingStore(path, i, directory_config)
+    return _text_embedding_stores[key]
+
+
+def cache_text_embedding_stores(map_fn, i, regenerate_cache=False, caching_batch_size=1):
+    for store in _text_embedding_stores.values():
+        if store.i == i:
+            store.cache_added(map_fn, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+
+
+class TextEmbeddingDataset:
+    # Text embeddings of the flattened captions of a metadata dataset, indexed by flattened caption number.
+    # With index_file, the indices are saved there when computed from keys, and memory mapped from it.
+    def __init__(self, store, keys, index_file=None):
+        self.store = store
+        self.keys = keys
+        self.index_file = index_file
+        self.te_indices = None
+
+    def load(self):
+        self.store.open()
+        if self.keys is not None:
+            self.te_indices = self.store.indices(self.keys)
+            self.keys = None
+            if self.index_file is not None:
+                np.save(self.index_file, self.te_indices)
+        if self.index_file is not None:
+            self.te_indices = np.load(self.index_file, mmap_mode='r')
+
+    def get_text_embeddings(self, caption_idx):
+        if self.te_indices is None:
+            # Made while caching and never loaded. Happens when caching ran in a thread of this process, whose
+            # size bucket datasets are still around after loading.
+            self.load()
+        return self.store[int(self.te_indices[caption_idx])]
+
+
+def _cache_text_embeddings(metadata_dataset, map_fn, i, cache_dir, text_embedding_cache_dir, regenerate_cache, directory_config, file_signatures):
 
     def flatten_captions(example):
         result = {key: [] for key in example}
@@ -183,26 +804,39 @@ def _cache_text_embeddings(metadata_dataset, map_fn, i, cache_dir, regenerate_ca
                     result[key].append(value[i])
         return result
 
+    store = _get_text_embedding_store(text_embedding_cache_dir, i, directory_config)
+    index_file = None
+    if map_fn is None and SHARED_INDEXES:
+        index_file = cache_dir / f'text_embedding_indices_{i}.npy'
+        if not is_main_process():
+            # The main process loads first and saves the indices, so there's no need to flatten captions or compute keys.
+            te_dataset = TextEmbeddingDataset(store, None, index_file)
+            te_dataset.load()
+            return te_dataset
+
     flattened_captions = metadata_dataset.map(flatten_captions, batched=True, keep_in_memory=True, remove_columns=metadata_dataset.column_names)
-    te_dataset = _map_and_cache(
-        flattened_captions,
-        map_fn,
-        cache_dir,
-        cache_file_prefix=f'text_embeddings_{i}_',
-        new_fingerprint_args=[i],
-        regenerate_cache=regenerate_cache,
-        caching_batch_size=caching_batch_size,
-    )
-    assert len(te_dataset) == len(flattened_captions)
-    return TextEmbeddingDataset(te_dataset, flattened_captions)
+    keys = store.content_keys(flattened_captions, file_signatures)
+    if map_fn is not None:
+        # encoded by cache_text_embedding_stores() once every dataset has added its captions
+        store.add(flattened_captions, keys)
+        # text embeddings used to be cached separately in each bucket
+        old_cache_dir = cache_dir / f'text_embeddings_{i}'
+        if old_cache_dir.exists():
+            shutil.rmtree(old_cache_dir)
+    te_dataset = TextEmbeddingDataset(store, keys, index_file)
+    if map_fn is None:
+        te_dataset.load()
+    return te_dataset
 
 
 # The smallest unit of a dataset. Represents a single size bucket from a single folder of images
 # and captions on disk. Not batched; returns individual items.
 class SizeBucketDataset:
-    def __init__(self, metadata_dataset, directory_config, size_bucket, cache_base):
+    def __init__(self, metadata_dataset, directory_config, size_bucket, cache_base, file_signatures, text_embedding_cache_dir):
         self.metadata_dataset = metadata_dataset
         self.directory_config = directory_config
+        self.file_signatures = file_signatures
+        self.text_embedding_cache_dir = text_embedding_cache_dir
         self.size_bucket = size_bucket
         self.path = Path(self.directory_config['path'])
         self.cache_dir = cache_base / f'cache_{bucket_suffix(size_bucket)}'
@@ -230,67 +864,67 @@ class SizeBucketDataset:
             cache_file_prefix='latents_',
             regenerate_cache=regenerate_cache,
             caching_batch_size=caching_batch_size,
+            compression=self.directory_config['cache_compression'],
+            byte_shuffle=self.directory_config['cache_byte_shuffle'],
+            # Latents don't depend on the captions, so editing a caption only re-caches its text embeddings.
+            content_keys=lambda: self.file_signatures.content_keys(
+                self.metadata_dataset,
+                [c for c in self.metadata_dataset.column_names if c != 'caption'],
+            ),
+            stream_tar_files=self.directory_config['tar_streaming'],
         )
         assert len(self.latent_dataset) == len(self.metadata_dataset)
 
-        iteration_order_cache_dir = self.cache_dir / 'iteration_order'
+        # (latents_idx, caption_number) of each item, where its caption is in the caption buffer, and the index of its
+        # caption in the flattened captions, which is what text embeddings are looked up by
+        iteration_order_file = self.cache_dir / 'iteration_order.npy'
+        caption_buffer_file = self.cache_dir / 'iteration_order_captions.npy'
+        caption_offsets_file = self.cache_dir / 'iteration_order_caption_offsets.npy'
+        text_embedding_idx_file = self.cache_dir / 'iteration_order_text_embedding_idx.npy'
 
-        if regenerate_cache or not iteration_order_cache_dir.exists() or not trust_cache:
+        if regenerate_cache or not text_embedding_idx_file.exists() or not trust_cache:
             print('Building iteration order')
-            image_spec_to_latents_idx = {
-                tuple(image_spec): i
-                for i, image_spec in enumerate(self.metadata_dataset['image_spec'])
-            }
-
-            equal_num_captions = True
-            num_captions = None
-            for example in self.metadata_dataset.select_columns(['caption']):
-                n = len(example['caption'])
-                if num_captions is not None and n != num_captions:
-                    equal_num_captions = False
-                    break
-                num_captions = n
-
-            if equal_num_captions:
-                # If all images have the same number of captions, set things up so we read (mostly) sequentially off disk. The metadata was already shuffled in the beginning.
-                iteration_order_by_caption_num = [[] for _ in range(num_captions)]
-                seed = 0
-                for example in self.metadata_dataset.select_columns(['image_spec', 'caption']):
-                    image_spec = example['image_spec']
-                    captions = example['caption']
-                    shuffle_with_seed(captions, seed)
-                    seed += 1
-                    latents_idx = image_spec_to_latents_idx[tuple(image_spec)]
-                    for i, caption in enumerate(captions):
-                        iteration_order_by_caption_num[i].append((image_spec, latents_idx, caption, i))
-                iteration_order_list = []
-                for l in iteration_order_by_caption_num:
-                    iteration_order_list.extend(l)
-            else:
-                iteration_order_list = []
-                for example in self.metadata_dataset.select_columns(['image_spec', 'caption']):
-                    image_spec = example['image_spec']
-                    captions = example['caption']
-                    latents_idx = image_spec_to_latents_idx[tuple(image_spec)]
-                    for i, caption in enumerate(captions):
-                        iteration_order_list.append((image_spec, latents_idx, caption, i))
-                shuffle_with_seed(iteration_order_list, 42)
-
-            iteration_order_dict = defaultdict(list)
-            for image_spec, latents_idx, caption, caption_number in iteration_order_list:
-                iteration_order_dict['image_spec'].append(image_spec)
-                iteration_order_dict['latents_idx'].append(latents_idx)
-                iteration_order_dict['caption'].append(caption)
-                iteration_order_dict['caption_number'].append(caption_number)
-            iteration_order = datasets.Dataset.from_dict(iteration_order_dict)
-            iteration_order.save_to_disk(str(iteration_order_cache_dir))
-            del iteration_order
-
-        self.iteration_order = datasets.load_from_disk(str(iteration_order_cache_dir))
+            self._build_iteration_order(iteration_order_file, caption_buffer_file, caption_offsets_file, text_embedding_idx_file)
+            # iteration order used to be saved as a Dataset
+            old_iteration_order_cache_dir = self.cache_dir / 'iteration_order'
+            if old_iteration_order_cache_dir.exists():
+                shutil.rmtree(old_iteration_order_cache_dir)
+
+        self.iteration_order = np.load(iteration_order_file, mmap_mode='r')
+        self.caption_buffer = np.load(caption_buffer_file, mmap_mode='r')
+        self.caption_offsets = np.load(caption_offsets_file, mmap_mode='r')
+        self.text_embedding_idx = np.load(text_embedding_idx_file, mmap_mode='r')
+
+    def _build_iteration_order(self, iteration_order_file, caption_buffer_file, caption_offsets_file, text_embedding_idx_file):
+        captions = self.metadata_dataset.with_format('arrow')[:]['caption']
+        num_captions = pc.list_value_length(captions).to_numpy()
+        # Latents are cached in the order of the metadata, so the latents index of an example is its row.
+        num_rows = len(num_captions)
+        row_caption_offsets = np.concatenate([[0], np.cumsum(num_captions)])
+
+        if num_rows > 0 and (num_captions == num_captions[0]).all():
+            # If all images have the same number of captions, set things up so we read (mostly) sequentially off disk. The metadata was already shuffled in the beginning.
+            # Every image's captions are put in a random order, then all the first captions come first, and so on.
+            caption_permutations = np.random.default_rng(0).permuted(np.tile(np.arange(num_captions[0]), (num_rows, 1)), axis=1)
+            latents_idx = np.tile(np.arange(num_rows), num_captions[0])
+            caption_number = caption_permutations.T.ravel()
+        else:
+            latents_idx = np.repeat(np.arange(num_rows), num_captions)
+            caption_number = np.arange(len(latents_idx)) - np.repeat(row_caption_offsets[:-1], num_captions)
+            order = np.random.default_rng(42).permutation(len(latents_idx))
+            latents_idx, caption_number = latents_idx[order], caption_number[order]
+
+        caption_buffer, offsets = string_array_to_numpy(pc.list_flatten(captions))
+        # Captions are flattened in the same order for the text embeddings, see _cache_text_embeddings().
+        caption_idx = row_caption_offsets[latents_idx] + caption_number
+        np.save(iteration_order_file, np.stack([latents_idx, caption_number], axis=1).astype(np.int32))
+        np.save(caption_buffer_file, caption_buffer)
+        np.save(caption_offsets_file, np.stack([offsets[caption_idx], offsets[caption_idx + 1]], axis=1))
+        np.save(text_embedding_idx_file, caption_idx.astype(np.int64))
 
     def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
         print(f'caching text embeddings: {self.size_bucket}')
-        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, regenerate_cache, caching_batch_size)
+        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, self.text_embedding_cache_dir, regenerate_cache, self.directory_config, self.file_signatures)
         self.text_embedding_datasets.append(te_dataset)
 
     def add_text_embedding_dataset(self, te_dataset):
@@ -298,15 +932,19 @@ class SizeBucketDataset:
 
     def __getitem__(self, idx):
         idx = idx % len(self.iteration_order)
-        entry = self.iteration_order[idx]
+        latents_idx = self.iteration_order[idx, 0]
 
-        ret = self.latent_dataset[entry['latents_idx']]
+        ret = self.latent_dataset[int(latents_idx)]
 
         use_uncond = UNCOND_FRACTION > 0 and random.random() < UNCOND_FRACTION
-        caption = '' if use_uncond else entry['caption']
+        if use_uncond:
+            caption = ''
+        else:
+            start, end = self.caption_offsets[idx]
+            caption = self.caption_buffer[start:end].tobytes().decode()
 
         for ds, uncond_ds in zip(self.text_embedding_datasets, self.uncond_text_embeddings):
-            emb_dict = uncond_ds[0] if use_uncond else ds.get_text_embeddings(tuple(entry['image_spec']), entry['caption_number'])
+            emb_dict = uncond_ds[0] if use_uncond else ds.get_text_embeddings(self.text_embedding_idx[idx])
             ret.update(emb_dict)
         ret['caption'] = caption
         return ret
@@ -375,11 +1013,13 @@ class ConcatenatedBatchedDataset:
 
 
 class ARBucketDataset:
-    def __init__(self, ar_frames, resolutions, metadata_dataset, directory_config, cache_base, round_to_multiple):
+    def __init__(self, ar_frames, resolutions, metadata_dataset, directory_config, cache_base, round_to_multiple, file_signatures, text_embedding_cache_dir):
         self.ar_frames = ar_frames
         self.resolutions = resolutions
         self.metadata_dataset = metadata_dataset
         self.directory_config = directory_config
+        self.file_signatures = file_signatures
+        self.text_embedding_cache_dir = text_embedding_cache_dir
         self.size_buckets = []
         self.path = Path(directory_config['path'])
         self.cache_base = cache_base
@@ -409,7 +1049,7 @@ class ARBucketDataset:
                 desc='Adding size bucket',
             )
             self.size_buckets.append(
-                SizeBucketDataset(metadata_with_size_bucket, self.directory_config, naming_size_bucket, self.cache_base)
+                SizeBucketDataset(metadata_with_size_bucket, self.directory_config, naming_size_bucket, self.cache_base, self.file_signatures, self.text_embedding_cache_dir)
             )
 
         for ds in self.size_buckets:
@@ -417,7 +1057,7 @@ class ARBucketDataset:
 
     def cache_text_embeddings(self, map_fn, i, regenerate_cache=False, caching_batch_size=1):
         print(f'caching text embeddings: {self.ar_frames}')
-        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, regenerate_cache, caching_batch_size)
+        te_dataset = _cache_text_embeddings(self.metadata_dataset, map_fn, i, self.cache_dir, self.text_embedding_cache_dir, regenerate_cache, self.directory_config, self.file_signatures)
         for size_bucket_dataset in self.size_buckets:
             size_bucket_dataset.add_text_embedding_dataset(te_dataset)
 
@@ -465,6 +1105,12 @@ class DirectoryDataset:
         self.default_mask_file = Path(self.directory_config['default_mask_file']) if 'default_mask_file' in self.directory_config else None
         self.cache_dir = self.path / 'cache' / self.model_name
         self.grouping_keys_json_file = self.cache_dir / 'metadata/grouping_keys.json'
+        self.file_signatures = FileSignatures(self.cache_dir / 'metadata/file_digests.db', full_hash=self.directory_config['cache_content_hash'])
+        # Directories with the same text_embedding_cache_dir share one text embedding store.
+        if text_embedding_cache_dir := self.directory_config['text_embedding_cache_dir']:
+            self.text_embedding_cache_dir = Path(text_embedding_cache_dir) / self.model_name
+        else:
+            self.text_embedding_cache_dir = self.cache_dir
 
         if not self.path.exists() or not self.path.is_dir():
             raise RuntimeError(f'Invalid path: {self.path}')
@@ -548,6 +1194,8 @@ class DirectoryDataset:
                         self.directory_config,
                         grouping_key,
                         self.cache_dir,
+                        self.file_signatures,
+                        self.text_embedding_cache_dir,
                     )
                 )
             else:
@@ -559,35 +1207,59 @@ class DirectoryDataset:
                         self.directory_config,
                         self.cache_dir,
                         self.round_to_multiple,
+                        self.file_signatures,
+                        self.text_embedding_cache_dir,
                     )
                 )
 
     def _group_metadata_and_save_to_disk(self, regenerate_cache=False, trust_cache=False):
         metadata_dataset = self._get_ungrouped_metadata(regenerate_cache=regenerate_cache, trust_cache=trust_cache)
-        grouped_metadata = defaultdict(lambda: defaultdict(list))
-        unique_grouping_keys = set()
-        for example in tqdm(metadata_dataset, desc='Grouping examples'):
-            if self.use_size_buckets:
-                grouping_key = tuple(example['size_bucket'])
-            else:
-                grouping_key = example['ar_bucket']
-                grouping_key = (grouping_key[0], int(grouping_key[1]))
-            unique_grouping_keys.add(grouping_key)
-            d = grouped_metadata[grouping_key]
-            for k, v in example.items():
-                d[k].append(v)
-        unique_grouping_keys = list(unique_grouping_keys)
-
+        # Work on the memory mapped Arrow table, so nothing is converted to Python objects per example, and only one
+        # bucket is materialized at a time.
+        table = metadata_dataset.with_format('arrow')[:]
+        media_info = pc.list_flatten(table['media_info']).to_numpy().reshape(-1, 3)
+        width, height, frames = media_info.T
+        is_video = (frames > 1)
+        log_ar = np.log(width / height)
+
+        # One integer bucket index per example, -1 if it fits no bucket.
         if self.use_size_buckets:
-            for size_bucket, metadata in grouped_metadata.items():
-                metadata = datasets.Dataset.from_dict(metadata)
-                grouped_cache_dir = self.cache_dir / f'metadata/grouped_metadata_{bucket_suffix(size_bucket)}'
-                metadata.save_to_disk(str(grouped_cache_dir))
+            bucket_idx = self._assign_size_buckets(log_ar, frames, is_video)
         else:
-            for ar_bucket, metadata in grouped_metadata.items():
-                metadata = datasets.Dataset.from_dict(metadata)
-                grouped_cache_dir = self.cache_dir / f'metadata/grouped_metadata_{bucket_suffix(ar_bucket)}'
-                metadata.save_to_disk(str(grouped_cache_dir))
+            ar_idx, frame_idx = self._assign_ar_buckets(log_ar, frames, is_video)
+            bucket_idx = np.where(frame_idx >= 0, ar_idx * len(self.frame_buckets) + frame_idx, -1)
+        for i in np.flatnonzero(bucket_idx < 0):
+            print(f'video with frames={frames[i]} is being skipped because it is too short')
+
+        # Stable sort, so examples keep their order within each bucket.
+        order = np.argsort(bucket_idx, kind='stable')
+        unique_bucket_idx, starts = np.unique(bucket_idx[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        # Column order matters, cache content keys are computed from the column values in order.
+        table = table.select([c for c in ['image_spec', 'mask_file', 'control_file', 'caption'] if c in table.column_names])
+
+        unique_grouping_keys = []
+        for b, start, end in zip(unique_bucket_idx, starts, ends):
+            if b < 0:
+                continue
+            rows = order[start:end]
+            if self.use_size_buckets:
+                grouping_key = tuple(int(x) for x in self.size_buckets[b])
+                ar_bucket = pa.nulls(len(rows))
+                size_bucket = repeat_list_array(grouping_key, len(rows), pa.int64())
+            else:
+                grouping_key = (float(self.ars[b // len(self.frame_buckets)]), int(self.frame_buckets[b % len(self.frame_buckets)]))
+                ar_bucket = repeat_list_array(grouping_key, len(rows), pa.float64())
+                size_bucket = pa.nulls(len(rows))
+            unique_grouping_keys.append(grouping_key)
+            metadata = (
+                table.take(rows)
+                .append_column('ar_bucket', ar_bucket)
+                .append_column('size_bucket', size_bucket)
+                .append_column('is_video', pa.array(is_video[rows]))
+            )
+            grouped_cache_dir = self.cache_dir / f'metadata/grouped_metadata_{bucket_suffix(grouping_key)}'
+            datasets.Dataset(metadata).save_to_disk(str(grouped_cache_dir))
 
         with open(self.grouping_keys_json_file, 'w') as f:
             json.dump(unique_grouping_keys, f)
@@ -600,38 +1272,74 @@ class DirectoryDataset:
         metadata_cache_file_2 = self.cache_dir / 'metadata/metadata.arrow'
 
         if regenerate_cache or not metadata_cache_file_1.exists() or not trust_cache:
-            print('Intermediate metadata is not cached. Enumerating all files.')
-            files = list(self.path.glob('*'))
-            # deterministic order
-            files.sort()
+            print('Intermediate metadata is not cached. Listing all files.')
+            # Only files that are new or have changed since the last listing are read.
+            listing = DirectoryListing(self.cache_dir / 'metadata/listing.db')
+            if regenerate_cache:
+                listing.clear()
+            files = listing.scan(self.path)
 
             # Mask can have any extension, it just needs to have the same stem as the image.
-            mask_file_stems = {path.stem: path for path in self.mask_path.glob('*') if path.is_file()} if self.mask_path is not None else {}
-            control_file_stems = {path.stem: path for path in self.control_path.glob('*') if path.is_file()} if self.control_path is not None else {}
-            control_paths_stems = [{path.stem: path for path in cp.glob('*') if path.is_file()} for cp in self.control_paths] if self.control_paths is not None else None
-            def process_file(file):
-                if file.suffix != '.tar':
-                    return [(None, str(file))]
-                with tarfile.TarFile(file) as tar_f:
-                    return [(str(file), name) for name in tar_f.getnames()]
+            def stems(path):
+                return {Path(name).stem: path / name for name in listing.scan(path)}
+            mask_file_stems = stems(self.mask_path) if self.mask_path is not None else {}
+            control_file_stems = stems(self.control_path) if self.control_path is not None else {}
+            control_paths_stems = [stems(cp) for cp in self.control_paths] if self.control_paths is not None else None
 
             captions_json = self.path / CAPTIONS_JSON_FILE
-            has_captions_json = captions_json.exists()
+            has_captions_json = CAPTIONS_JSON_FILE in files
+
+            media_names = [name for name in files if Path(name).suffix not in ('.txt', '.npz', '.json', '.parquet')]
+            caption_names = set() if has_captions_json else {name for name in files if Path(name).suffix == '.txt'}
+            infos = listing.get_info(self.path)
+            tasks = {}
+            tar_kind = 'tar_stream' if self.directory_config['tar_streaming'] else 'tar'
+            for name in media_names:
+                is_tar = Path(name).suffix == '.tar'
+                # tar files read before captions in tar files were supported are read again
+                if name not in infos or (is_tar and 'captions' not in infos[name]):
+                    tasks[name] = (str(self.path / name), tar_kind if is_tar else 'media', self.framerate)
+            for name in caption_names:
+                if name not in infos:
+                    tasks[name] = (str(self.path / name), 'caption', None)
+            listing.commit()
+            if len(tasks) > 0:
+                print(f'Reading {len(tasks)} new or changed files.')
+                if NUM_PROC > 1 and len(tasks) > 1:
+                    with mp.Pool(NUM_PROC) as pool:
+                        chunksize = min(METADATA_BATCH_SIZE, math.ceil(len(tasks) / NUM_PROC))
+                        results = list(tqdm(pool.imap(_read_listing_info, tasks.values(), chunksize=chunksize), total=len(tasks)))
+                else:
+                    results = [_read_listing_info(task) for task in tqdm(tasks.values())]
+                new_infos = dict(zip(tasks.keys(), results))
+                listing.set_info(self.path, new_infos)
+                listing.commit()
+                infos.update(new_infos)
 
             image_specs = []
-            caption_files = []
+            captions = []
+            media_info = []
             mask_files = []
             control_files = []
-            for file in tqdm(files):
-                if not file.is_file() or file.suffix == '.txt' or file.suffix == '.npz' or file.suffix == '.json' or file.suffix == '.parquet':
-                    continue
-                for image_spec in process_file(file):
+            for name in media_names:
+                info = infos[name]
+                if Path(name).suffix == '.tar':
+                    entries = [((str(self.path / name), member), info['media'][member]) for member in info['members']]
+                else:
+                    entries = [((None, str(self.path / name)), info)]
+                for image_spec, media in entries:
                     image_file = Path(image_spec[1])
-                    caption_file = image_file.with_suffix('.txt')
-                    if has_captions_json or not os.path.exists(caption_file):
-                        caption_file = ''
+                    if isinstance(media, dict):
+                        logger.warning(f'Media file {image_file} could not be opened. Skipping. The exception was: {media["error"]}')
+                        continue
+                    if image_spec[0] is None:
+                        caption_name = image_file.with_suffix('.txt').name
+                        caption = infos[caption_name] if caption_name in caption_names else None
+                    else:
+                        caption = info['captions'].get(str(PurePosixPath(image_spec[1]).with_suffix('.txt')), None)
+                    captions.append([caption] if caption is not None else None)
                     image_specs.append(image_spec)
-                    caption_files.append(str(caption_file))
+                    media_info.append(media)
                     # mask
                     if image_file.stem in mask_file_stems:
                         mask_files.append(str(mask_file_stems[image_file.stem]))
@@ -654,12 +1362,12 @@ class DirectoryDataset:
                         control_files.append(str(control_file_stems[image_file.stem]))
             assert len(image_specs) > 0, f'Directory {self.path} had no images/videos!'
 
-            d = {'image_spec': image_specs, 'caption_file': caption_files, 'mask_file': mask_files}
+            d = {'image_spec': image_specs, 'caption': captions, 'media_info': media_info, 'mask_file': mask_files}
             if self.control_path or self.control_paths:
                 d['control_file'] = control_files
             metadata_dataset = datasets.Dataset.from_dict(d)
 
-            if captions_json.exists():
+            if has_captions_json:
                 print('Loading captions JSON')
                 with open(captions_json) as f:
                     caption_data = json.load(f)
@@ -695,6 +1403,9 @@ class DirectoryDataset:
 
         print('Loading intermediate metadata dataset.')
         metadata_dataset = datasets.load_from_disk(str(metadata_cache_file_1))
+        if 'media_info' not in metadata_dataset.column_names:
+            print('Intermediate metadata is from an older version.')
+            return self._get_ungrouped_metadata(regenerate_cache=regenerate_cache, trust_cache=False)
 
         metadata_map_fn = self._metadata_map_fn()
         print('Caching ungrouped metadata.')
@@ -703,10 +1414,14 @@ class DirectoryDataset:
             cache_file_name=str(metadata_cache_file_2),
             load_from_cache_file=(not regenerate_cache and trust_cache),
             batched=True,
-            batch_size=1,
+            batch_size=METADATA_BATCH_SIZE,
             num_proc=NUM_PROC,
             remove_columns=metadata_dataset.column_names,
+            desc='Processing captions',
         )
+        if 'media_info' not in metadata_dataset.column_names:
+            print('Ungrouped metadata is from an older version.')
+            return self._get_ungrouped_metadata(regenerate_cache=regenerate_cache, trust_cache=False)
         return metadata_dataset
 
     def _set_defaults(self, directory_config, dataset_config):
@@ -714,137 +1429,66 @@ class DirectoryDataset:
         directory_config.setdefault('shuffle_tags', dataset_config.get('shuffle_tags', False))
         directory_config.setdefault('caption_prefix', dataset_config.get('caption_prefix', ''))
         directory_config.setdefault('num_repeats', dataset_config.get('num_repeats', 1))
+        directory_config.setdefault('cache_compression', dataset_config.get('cache_compression', None))
+        directory_config.setdefault('cache_byte_shuffle', dataset_config.get('cache_byte_shuffle', False))
+        directory_config.setdefault('cache_content_hash', dataset_config.get('cache_content_hash', False))
+        directory_config.setdefault('text_embedding_cache_dir', dataset_config.get('text_embedding_cache_dir', None))
+        directory_config.setdefault('tar_streaming', dataset_config.get('tar_streaming', False))
 
     def _metadata_map_fn(self):
-        tarfile_map = {}
-
         def fn(example):
-            # batch size always 1
-            caption_file = example['caption_file'][0]
-            image_spec = example['image_spec'][0]
-            image_file = Path(image_spec[1])
-            captions = None
-            if 'caption' in example:
-                # Already put in dataset from captions.json file.
-                captions = example['caption'][0]
-            if captions is None and caption_file:
-                with open(caption_file) as f:
-                    captions = [f.read().strip()]
-            if captions is None:
-                captions = ['']
-                logger.warning(f'Cound not find caption for {image_file}. Using empty caption.')
-            if self.directory_config['shuffle_tags'] and self.shuffle == 0: # backwards compatibility
-                self.shuffle = 1
-            captions = shuffle_captions(captions, self.shuffle, self.shuffle_delimiter, self.directory_config['caption_prefix'])
-            empty_return = {'image_spec': [], 'mask_file': [], 'caption': [], 'ar_bucket': [], 'size_bucket': [], 'is_video': []}
-            if self.control_path:
-                empty_return['control_file'] = []
-
-            if image_spec[0] is None:
-                tar_f = None
-                filepath_or_file = str(image_file)
-            else:
-                tar_filename = image_spec[0]
-                if tar_filename not in tarfile_map:
-                    tarfile_map[tar_filename] = tarfile.TarFile(tar_filename)
-                tar_f = tarfile_map[tar_filename]
-                filepath_or_file = tar_f.extractfile(str(image_file))
-
-            if image_file.suffix == '.webp':
-                # Make sure this this object stays alive so it doesn't close the file on us.
-                reader = imageio.get_reader(filepath_or_file)
-                frames = reader.get_length()
-                if frames > 1:
-                    raise NotImplementedError('WebP videos are not supported.')
-            try:
-                if image_file.suffix in VIDEO_EXTENSIONS:
-                    # 100% accurate frame count, but much slower.
-                    # frames = 0
-                    # for frame in imageio.v3.imiter(image_file):
-                    #     frames += 1
-                    #     height, width = frame.shape[:2]
-                    # TODO: this is an estimate of frame count. What happens if variable frame rate? Is
-                    # it still close enough?
-                    meta = imageio.v3.immeta(filepath_or_file)
-                    first_frame = next(imageio.v3.imiter(filepath_or_file))
-                    height, width = first_frame.shape[:2]
-                    assert self.framerate is not None, "Need model framerate but don't have it. This shouldn't happen. Is the framerate attribute on the model set?"
-                    frames = int(self.framerate * meta['duration'])
-                else:
-                    pil_img = Image.open(filepath_or_file)
-                    width, height = pil_img.size
-                    frames = 1
-            except Exception as e:
-                logger.warning(f'Media file {image_file} could not be opened. Skipping. The exception was: {e}')
-                return empty_return
-            finally:
-                if hasattr(filepath_or_file, 'close'):
-                    filepath_or_file.close()
-
-            is_video = (frames > 1)
-            log_ar = np.log(width / height)
-
-            if self.use_size_buckets:
-                size_bucket = self._find_closest_size_bucket(log_ar, frames, is_video)
-                if size_bucket is None:
-                    print(f'video with frames={frames} is being skipped because it is too short')
-                    return empty_return
-                ar_bucket = None
-            else:
-                ar_bucket = self._find_closest_ar_bucket(log_ar, frames, is_video)
-                if ar_bucket is None:
-                    print(f'video with frames={frames} is being skipped because it is too short')
-                    return empty_return
-                size_bucket = None
-
-            ret = {
-                'image_spec': [image_spec],
-                'mask_file': [example['mask_file'][0]],
-                'caption': [captions],
-                'ar_bucket': [ar_bucket],
-                'size_bucket': [size_bucket],
-                'is_video': [is_video],
-            }
+            ret = {'image_spec': [], 'mask_file': [], 'caption': [], 'media_info': []}
             if self.control_path:
-                ret['control_file'] = [example['control_file'][0]]
+                ret['control_file'] = []
+            for i, image_spec in enumerate(example['image_spec']):
+                image_file = Path(image_spec[1])
+                # From the caption file or captions.json, already put in the dataset.
+                captions = example['caption'][i]
+                if captions is None:
+                    captions = ['']
+                    logger.warning(f'Cound not find caption for {image_file}. Using empty caption.')
+                if self.directory_config['shuffle_tags'] and self.shuffle == 0: # backwards compatibility
+                    self.shuffle = 1
+                captions = shuffle_captions(captions, self.shuffle, self.shuffle_delimiter, self.directory_config['caption_prefix'])
+
+                ret['image_spec'].append(image_spec)
+                ret['mask_file'].append(example['mask_file'][i])
+                ret['caption'].append(captions)
+                ret['media_info'].append(example['media_info'][i])
+                if self.control_path:
+                    ret['control_file'].append(example['control_file'][i])
             return ret
 
         return fn
 
-    def _find_closest_ar_bucket(self, log_ar, frames, is_video):
+    def _assign_ar_buckets(self, log_ar, frames, is_video):
+        '''Vectorized AR bucket assignment. Returns the indices into self.ars and self.frame_buckets, with a frame bucket
+        index of -1 for videos that are too short for any frame bucket.'''
         # Best AR bucket is the one with the smallest AR difference in log space.
-        i = np.argmin(np.abs(log_ar - self.log_ars))
-        # find closest frame bucket where the number of frames is greater than or equal to the bucket
-        diffs = frames - self.frame_buckets
-        positive_diffs = diffs[diffs >= 0]
-        if len(positive_diffs) == 0:
-            # video not long enough to find any valid frame bucket
-            return None
-        j = np.argmin(positive_diffs)
-        if is_video and self.frame_buckets[j] == 1:
-            # don't let video be mapped to the image frame bucket
-            return None
-        ar_bucket = (self.ars[i], self.frame_buckets[j])
-        return ar_bucket
-
-    def _find_closest_size_bucket(self, log_ar, frames, is_video):
-        # Best AR bucket is the one with the smallest AR difference in log space.
-        ar_diffs = np.abs(log_ar - self.log_ars)
-        candidate_size_buckets = self.size_buckets[np.argsort(ar_diffs, kind='stable')]
-        # Find closest size bucket where the number of frames is greater than or equal to the bucket.
-        # self.size_buckets was already sorted longest -> shortest frame length
-        found = False
-        for size_bucket in candidate_size_buckets:
-            if is_video and size_bucket[-1] == 1:
-                # don't let video be mapped to the image frame bucket
-                continue
-            if frames >= size_bucket[-1]:
-                found = True
-                break
-        if not found:
-            # video not long enough to find any valid frame bucket
-            return None
-        return size_bucket
+        ar_idx = np.argmin(np.abs(log_ar[:, None] - self.log_ars[None, :]), axis=1)
+        # Largest frame bucket that is less than or equal to the number of frames. self.frame_buckets is sorted.
+        frame_idx = np.searchsorted(self.frame_buckets, frames, side='right') - 1
+        # don't let video be mapped to the image frame bucket
+        frame_idx[is_video & (self.frame_buckets[np.maximum(frame_idx, 0)] == 1)] = -1
+        return ar_idx, frame_idx
+
+    def _assign_size_buckets(self, log_ar, frames, is_video, chunk_size=65536):
+        '''Vectorized size bucket assignment. Returns indices into self.size_buckets, -1 for videos that are too short for
+        any size bucket.'''
+        bucket_log_ars = np.log(self.size_buckets[:, 0] / self.size_buckets[:, 1])
+        bucket_frames = self.size_buckets[:, -1]
+        size_idx = np.empty(len(log_ar), dtype=np.int64)
+        # (files, buckets) matrices, so work in chunks to bound memory
+        for start in range(0, len(log_ar), chunk_size):
+            end = start + chunk_size
+            ar_diffs = np.abs(log_ar[start:end, None] - bucket_log_ars[None, :])
+            # Size bucket must have at most the number of frames, and video can't go in the image frame bucket.
+            valid = (frames[start:end, None] >= bucket_frames[None, :]) & ~(is_video[start:end, None] & (bucket_frames[None, :] == 1))
+            # Closest AR among the valid buckets. argmin takes the first on ties, and self.size_buckets was already
+            # sorted longest -> shortest frame length.
+            ar_diffs[~valid] = np.inf
+            size_idx[start:end] = np.where(valid.any(axis=1), np.argmin(ar_diffs, axis=1), -1)
+        return size_idx
 
     def _process_user_provided_ars(self, ars):
         ar_buckets = []
@@ -1021,102 +1665,203 @@ class Dataset:
             ds.cache_text_embeddings(map_fn, i, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
 
 
-def _cache_fn(datasets, queue, preprocess_media_file_fn, num_text_encoders, regenerate_cache, trust_cache, caching_batch_size):
-    # Dataset map() starts a bunch of processes. Make sure torch uses a limited number of threads
-    # to avoid CPU contention.
-    # TODO: if we ever change Datasets map to use spawn instead of fork, this might not work.
-    #torch.set_num_threads(os.cpu_count() // NUM_PROC)
-    # HF Datasets map can randomly hang if this is greater than one (???)
-    # See https://github.com/pytorch/pytorch/issues/10996
-    # Alternatively, we could try fixing this by using spawn instead of fork.
-    torch.set_num_threads(1)
+class _CachingMapFn:
+    '''What _map_and_cache() maps a dataset with, one method per stage of its pipeline. decode() runs in the map
+    workers and turns a batch of rows into a list of items, or is None to use the rows as items. submit() sends a
+    batch of items to be encoded and returns a request id, and result() returns the encoded items of a request, one
+    dict per item. workers is a TaskClient for the caching workers of all ranks, which then cache a slice of the
+    dataset each, or None to cache all of it in this process.'''
+    decode = None
+    workers = None
 
-    for ds in datasets:
-        ds.cache_metadata(regenerate_cache=regenerate_cache, trust_cache=trust_cache)
+    def __init__(self, client):
+        self.client = client
+
+    def result(self, request_id, items):
+        result = self.client.result(request_id)  # dict of batched results
+        return [{k: v[i] for k, v in result.items()} for i in range(len(items))]
 
-    pipes = {}
 
-    def latents_map_fn(example, rank):
+class _LatentsMapFn(_CachingMapFn):
+    def __init__(self, client, preprocess_media_file_fn, workers=None):
+        super().__init__(client)
+        self.preprocess_media_file_fn = preprocess_media_file_fn
+        self.workers = workers
+
+    def decode(self, example):
         is_edit_dataset = ('control_file' in example)
+        # bytes of files already read from tar files, see _iter_batches_in_tar_order()
+        media_bytes = example.get('media_bytes', None)
         first_size_bucket = example['size_bucket'][0]
-        tensors_and_masks = []
-        image_specs = []
-        captions = []
-        control_tensors_and_masks = []
+        items = []
         for i, (image_spec, mask_path, size_bucket, caption) in enumerate(
             zip(example['image_spec'], example['mask_file'], example['size_bucket'], example['caption'])
         ):
             assert size_bucket == first_size_bucket
-            items = preprocess_media_file_fn(image_spec, mask_path, size_bucket)
-            tensors_and_masks.extend(items)
-            image_specs.extend([image_spec] * len(items))
-            captions.extend([caption] * len(items))
+            if media_bytes is not None and media_bytes[i] is not None:
+                tensors_and_masks = self.preprocess_media_file_fn(image_spec, mask_path, size_bucket, data=media_bytes[i])
+            else:
+                tensors_and_masks = self.preprocess_media_file_fn(image_spec, mask_path, size_bucket)
+            control = None
             if is_edit_dataset:
                 control_file = example['control_file'][i]
                 if isinstance(control_file, list):
-                    multi_control = []
+                    control = []
                     for cf in control_file:
-                        control_items = preprocess_media_file_fn((None, cf), None, size_bucket)
+                        control_items = self.preprocess_media_file_fn((None, cf), None, size_bucket)
                         assert len(control_items) == 1
-                        multi_control.append(control_items[0])
-                    assert len(items) == 1
-                    control_tensors_and_masks.append(multi_control)
+                        control.append(control_items[0])
                 else:
-                    control_items = preprocess_media_file_fn((None, control_file), None, size_bucket)
+                    control_items = self.preprocess_media_file_fn((None, control_file), None, size_bucket)
                     assert len(control_items) == 1
-                    assert len(items) == 1
-                    control_tensors_and_masks.append(control_items[0])
-            else:
-                control_tensors_and_masks.append(None)
-
-        if len(tensors_and_masks) == 0:
-            assert not is_edit_dataset
-            return {'latents': [], 'mask': [], 'image_spec': [], 'caption': []}
-
-        caching_batch_size = len(example['image_spec'])
-        results = defaultdict(list)
-        for i in range(0, len(tensors_and_masks), caching_batch_size):
-            tensor = torch.stack([t[0] for t in tensors_and_masks[i:i+caching_batch_size]])
-            c_tensor = torch.stack([t[0] for t in control_tensors_and_masks[i:i+caching_batch_size]]) if is_edit_dataset else None
-            if rank not in pipes:
-                pipes[rank] = mp.Pipe(duplex=False)
-            parent_conn, child_conn = pipes[rank]
-            queue.put((0, tensor, c_tensor, child_conn))
-            result = parent_conn.recv()  # dict
-            for k, v in result.items():
-                results[k].append(v)
-        # concatenate the list of tensors at each key into one batched tensor
-        for k, v in results.items():
-            results[k] = torch.cat(v)
-        results['image_spec'] = image_specs
-        results['mask'] = [t[1] for t in tensors_and_masks]
-        results['caption'] = captions
+                    control = control_items[0]
+                assert len(tensors_and_masks) == 1
+            for tensor, mask in tensors_and_masks:
+                items.append({'tensor': tensor, 'mask': mask, 'control': control, 'image_spec': image_spec, 'caption': caption})
+        if len(items) > 0:
+            # Views of one tensor are sent back from the map worker in a single piece of shared memory.
+            for item, tensor in zip(items, torch.stack([item['tensor'] for item in items])):
+                item['tensor'] = tensor
+        return items
+
+    def submit(self, items):
+        tensor = torch.stack([item['tensor'] for item in items])
+        c_tensor = torch.stack([item['control'][0] for item in items]) if items[0]['control'] is not None else None
+        return self.client.submit((0, tensor, c_tensor))
+
+    def result(self, request_id, items):
+        results = super().result(request_id, items)
+        for result, item in zip(results, items):
+            result['image_spec'] = item['image_spec']
+            result['mask'] = item['mask']
+            result['caption'] = item['caption']
         return results
 
+
+class _TextEmbeddingMapFn(_CachingMapFn):
+    def __init__(self, client, i):
+        super().__init__(client)
+        self.i = i
+
+    def submit(self, items):
+        control_file = [item['control_file'] for item in items] if 'control_file' in items[0] else None
+        return self.client.submit((self.i, [item['caption'] for item in items], [item['is_video'] for item in items], control_file))
+
+
+def _vae_batch_key(task):
+    # VAE tasks can be encoded together if their tensors have the same shapes apart from the batch dimension, which
+    # they do if they're from the same size bucket.
+    _, tensor, control_tensor = task
+    if control_tensor is None:
+        control_key = None
+    elif isinstance(control_tensor, list):
+        control_key = tuple((t.shape[1:], t.dtype) for t in control_tensor)
+    else:
+        control_key = (control_tensor.shape[1:], control_tensor.dtype)
+    return tensor.shape[1:], tensor.dtype, control_key
+
+
+def _merge_vae_tasks(tasks):
+    tensor = torch.cat([task[1] for task in tasks])
+    control_tensors = [task[2] for task in tasks]
+    if control_tensors[0] is None:
+        control_tensor = None
+    elif isinstance(control_tensors[0], list):
+        control_tensor = [torch.cat(tensors) for tensors in zip(*control_tensors)]
+    else:
+        control_tensor = torch.cat(control_tensors)
+    return 0, tensor, control_tensor
+
+
+def _split_results(results, sizes):
+    # Splits a dict of batched results into one dict for each of sizes.
+    split = [{} for _ in sizes]
+    for k, v in results.items():
+        start = 0
+        for result, size in zip(split, sizes):
+            result[k] = v[start:start+size]
+            start += size
+    return split
+
+
+def _is_on_gpu(module):
+    return any(p.device.type == 'cuda' for p in module.parameters())
+
+
+def _module_nbytes(module):
+    return sum(t.numel() * t.element_size() for t in itertools.chain(module.parameters(), module.buffers()))
+
+
+def _cache_worker_fn(conn, rank, client, preprocess_media_file_fn):
+    # Caches the slices of latents datasets that _map_and_cache() sends it, encoding with the GPU of its rank. Sends
+    # the address to send them to through conn first.
+    torch.set_num_threads(1)
+    server = TaskServer()
+    conn.send(server.address)
+    conn.close()
+    map_fn = _LatentsMapFn(client, preprocess_media_file_fn)
+    while True:
+        request = server.get()
+        if request is None:
+            break
+        dataset, writer_args, caching_batch_size, stream_tar_files, one_item_per_row = request.task
+        entries = []
+        writer = _CacheWriter(
+            ShardWriter(**writer_args, rank=rank),
+            lambda entry, position: entries.append((entry, position)),
+            max_pending=client.max_in_flight,
+        )
+        _cache_rows(
+            dataset,
+            map_fn,
+            writer,
+            caching_batch_size,
+            stream_tar_files=stream_tar_files,
+            one_item_per_row=one_item_per_row,
+            total_batches=math.ceil(len(dataset) / caching_batch_size),
+            # the slices are about the same size, so one progress bar is enough
+            show_progress=(rank == 0),
+            name=f'Rank {rank} cached',
+        )
+        request.reply(entries)
+    server.close()
+
+
+def _cache_fn(datasets, client, workers, preprocess_media_file_fn, num_text_encoders, regenerate_cache, trust_cache, caching_batch_size):
+    # Dataset map() starts a bunch of processes. Make sure torch uses a limited number of threads
+    # to avoid CPU contention.
+    # TODO: if we ever change Datasets map to use spawn instead of fork, this might not work.
+    #torch.set_num_threads(os.cpu_count() // NUM_PROC)
+    # HF Datasets map can randomly hang if this is greater than one (???)
+    # See https://github.com/pytorch/pytorch/issues/10996
+    # Alternatively, we could try fixing this by using spawn instead of fork.
+    torch.set_num_threads(1)
+
+    for ds in datasets:
+        ds.cache_metadata(regenerate_cache=regenerate_cache, trust_cache=trust_cache)
+
+    # Everything for one submodel is cached before anything for the next, over all the datasets, so that each is
+    # moved to the GPU once: the latents of every dataset, then the text embeddings of each text encoder.
+    latents_map_fn = _LatentsMapFn(client, preprocess_media_file_fn, workers)
     for ds in datasets:
         ds.cache_latents(latents_map_fn, regenerate_cache=regenerate_cache, trust_cache=trust_cache, caching_batch_size=caching_batch_size)
 
     for text_encoder_idx in range(num_text_encoders):
-        def text_embedding_map_fn(example, rank):
-            if rank not in pipes:
-                pipes[rank] = mp.Pipe(duplex=False)
-            parent_conn, child_conn = pipes[rank]
-            control_file = example['control_file'] if 'control_file' in example else None
-            queue.put((text_encoder_idx+1, example['caption'], example['is_video'], control_file, child_conn))
-            result = parent_conn.recv()  # dict
-            result['image_spec'] = example['image_spec']
-            return result
+        text_embedding_map_fn = _TextEmbeddingMapFn(client, text_encoder_idx+1)
         for ds in datasets:
             ds.cache_text_embeddings(text_embedding_map_fn, text_encoder_idx+1, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
+        cache_text_embedding_stores(text_embedding_map_fn, text_encoder_idx+1, regenerate_cache=regenerate_cache, caching_batch_size=caching_batch_size)
 
     # signal that we're done
-    queue.put(None)
+    if workers is not None:
+        workers.stop_servers()
+    client.stop_servers()
 
 
 # Helper class to make caching multiple datasets more efficient by moving
 # models to GPU as few times as needed.
 class DatasetManager:
-    def __init__(self, model, regenerate_cache=False, trust_cache=False, caching_batch_size=1):
+    def __init__(self, model, regenerate_cache=False, trust_cache=False, caching_batch_size=1, vae_max_batch_size=None, vae_batch_timeout=0):
         self.model = model
         self.vae = self.model.get_vae()
         self.text_encoders = self.model.get_text_encoders()
@@ -1130,6 +1875,16 @@ class DatasetManager:
         self.regenerate_cache = regenerate_cache
         self.trust_cache = trust_cache
         self.caching_batch_size = caching_batch_size
+        # VAE requests of the same size bucket are encoded together, up to this many items. They are collected for up
+        # to vae_batch_timeout seconds after the first one, or just taken from those already waiting if 0.
+        self.vae_max_batch_size = caching_batch_size if vae_max_batch_size is None else vae_max_batch_size
+        self.vae_batch_timeout = vae_batch_timeout
+        self.num_vae_batches = 0
+        self.num_vae_items = 0
+        # Indices of the submodels on the GPU, the times each was moved there, and the bytes moved to and from the GPU.
+        self.on_gpu = set()
+        self.num_moves_to_gpu = [0] * len(self.submodels)
+        self.bytes_moved = 0
         self.datasets = []
 
     def register(self, dataset):
@@ -1138,15 +1893,27 @@ class DatasetManager:
     # Some notes for myself:
     # Use the third-party multiprocess library because HF Datasets uses it for the map() calls.
     # Mix and match native multiprocessing / torch.multiprocessing and multiprocess at your peril! Things can break.
-    # In patches.py we register reductions so Tensors sent over Queues and Pipes are efficient just like in torch.multiprocessing.
+    # Tasks and results go through a TaskServer in each process (one per GPU). Their tensors are passed in shared memory.
     def cache(self, unload_models=True):
-        if is_main_process():
-            manager = mp.Manager()
-            queue = [manager.Queue()]
-        else:
-            queue = [None]
-        torch.distributed.broadcast_object_list(queue, src=0, group=dist.get_world_group())
-        queue = queue[0]
+        self.on_gpu = {i for i, submodel in enumerate(self.submodels) if isinstance(submodel, nn.Module) and _is_on_gpu(submodel)}
+        server = TaskServer()
+        addresses = [None] * dist.get_world_size()
+        torch.distributed.all_gather_object(addresses, server.address, group=dist.get_world_group())
+
+        # With multiple GPUs, latents are cached by a worker process on each rank, so decoding and writing are spread
+        # over the ranks too. The caching process gives each worker a slice of every bucket, and builds the index.
+        worker_process = None
+        workers = None
+        if dist.get_world_size() > 1:
+            address_conn, child_conn = mp.Pipe(duplex=False)
+            worker_process = mp.Process(
+                target=_cache_worker_fn,
+                args=(child_conn, dist.get_rank(), TaskClient([server.address]), self.model.get_preprocess_media_file_fn()),
+            )
+            worker_process.start()
+            worker_addresses = [None] * dist.get_world_size()
+            torch.distributed.all_gather_object(worker_addresses, address_conn.recv(), group=dist.get_world_group())
+            workers = TaskClient(worker_addresses, max_in_flight=len(worker_addresses))
 
         # start up a process to run through the dataset caching flow
         if is_main_process():
@@ -1154,7 +1921,8 @@ class DatasetManager:
                 target=_cache_fn,
                 args=(
                     self.datasets,
-                    queue,
+                    TaskClient(addresses),
+                    workers,
                     self.model.get_preprocess_media_file_fn(),
                     len(self.text_encoders),
                     self.regenerate_cache,
@@ -1165,14 +1933,20 @@ class DatasetManager:
             process.start()
 
         # loop on the original processes (one per GPU) to handle tasks requiring GPU models (VAE, text encoders)
+        pending = deque()
         while True:
-            task = queue.get()
-            if task is None:
-                # Propagate None so all worker processes break out of this loop.
-                # This is safe because it's a FIFO queue. The first None always comes after all work items.
-                queue.put(None)
+            requests = self._get_requests(server, pending)
+            if requests[0] is None:
+                # The caching process is done, and has received all results.
                 break
-            self._handle_task(task)
+            self._handle_requests(requests)
+        server.close()
+        if worker_process is not None:
+            worker_process.join()
+        if self.num_vae_batches > 0:
+            print(f'VAE encoded {self.num_vae_items} items in {self.num_vae_batches} batches, {self.num_vae_items / self.num_vae_batches:.1f} per batch')
+        if sum(self.num_moves_to_gpu) > 0:
+            print(f'Swapped models to the GPU {sum(self.num_moves_to_gpu)} times, moved {self.bytes_moved / 1024**3:.2f} GiB between CPU and GPU')
 
         if unload_models:
             # Free memory in all unneeded submodels. This is easier than trying to delete every reference.
@@ -1192,35 +1966,90 @@ class DatasetManager:
             process.join()
 
         # Now load all datasets from cache.
-        for ds in self.datasets:
-            ds.cache_metadata(trust_cache=True)
-            ds.cache_latents(None, trust_cache=True)
-            for i in range(1, len(self.text_encoders)+1):
-                ds.cache_text_embeddings(None, i)
+        log_memory_usage('before loading datasets')
+        with zero_first() if SHARED_INDEXES else contextlib.nullcontext():
+            for ds in self.datasets:
+                ds.cache_metadata(trust_cache=True)
+                ds.cache_latents(None, trust_cache=True)
+                for i in range(1, len(self.text_encoders)+1):
+                    ds.cache_text_embeddings(None, i)
+        # Content keys have all been resolved to indices.
+        for store in _text_embedding_stores.values():
+            store.key_to_idx = None
+        log_memory_usage('after loading datasets')
+
+    def _get_requests(self, server, pending):
+        '''Returns the next requests to handle together. That's one request, or VAE requests of the same size bucket.
+        Requests taken from the server but not handled yet are kept in pending, in order.'''
+        request = pending.popleft() if len(pending) > 0 else server.get()
+        if request is None or request.task[0] != 0:
+            return [request]
+        key = _vae_batch_key(request.task)
+        requests = [request]
+        size = len(request.task[1])
+        deadline = time.perf_counter() + self.vae_batch_timeout
+        while size < self.vae_max_batch_size:
+            if len(pending) == 0:
+                try:
+                    pending.append(server.get(timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+            other = pending[0]
+            if other is None or other.task[0] != 0 or _vae_batch_key(other.task) != key or size + len(other.task[1]) > self.vae_max_batch_size:
+                break
+            requests.append(pending.popleft())
+            size += len(other.task[1])
+        return requests
+
+    def _handle_requests(self, requests):
+        start = time.perf_counter()
+        if len(requests) == 1:
+            results = [self._handle_task(requests[0].task)]
+        else:
+            tasks = [request.task for request in requests]
+            results = _split_results(self._handle_task(_merge_vae_tasks(tasks)), [len(task[1]) for task in tasks])
+        if requests[0].task[0] == 0:
+            self.num_vae_batches += 1
+            self.num_vae_items += sum(len(request.task[1]) for request in requests)
+        # the requests share the time it took
+        busy_time = (time.perf_counter() - start) / len(requests)
+        for request, result in zip(requests, results):
+            request.reply(result, busy_time=busy_time)
+
+    def _move_to_gpu(self, id):
+        # Moves the submodel to cuda, and the ones there to cpu. _cache_fn() sends all the tasks of a submodel before
+        # those of the next one, so this happens once for each submodel with anything to cache.
+        if id in self.on_gpu:
+            return
+        for i in self.on_gpu:
+            self.submodels[i].to('cpu')
+            self.bytes_moved += _module_nbytes(self.submodels[i])
+        self.submodels[id].to('cuda')
+        self.bytes_moved += _module_nbytes(self.submodels[id])
+        self.on_gpu = {id}
+        self.num_moves_to_gpu[id] += 1
+        if self.num_moves_to_gpu[id] == 2:
+            name = 'VAE' if id == 0 else f'text encoder {id}'
+            logger.warning(f'{name} was moved to the GPU again while caching, its tasks were not all sent together')
 
     @torch.no_grad()
     def _handle_task(self, task):
         id = task[0]
-        # moved needed submodel to cuda, and everything else to cpu
         submodel = self.submodels[id]
         if isinstance(submodel, nn.Module):
-            if next(self.submodels[id].parameters()).device.type != 'cuda':
-                for i, submodel in enumerate(self.submodels):
-                    if i != id:
-                        submodel.to('cpu')
-                self.submodels[id].to('cuda')
+            self._move_to_gpu(id)
         else:
             # ComfyUI model in a wrapper class that delays loading until the model is needed.
-            self.submodels[id].load_model_if_needed()
+            submodel.load_model_if_needed()
         if id == 0:
-            tensor, control_tensor, pipe = task[1:]
+            tensor, control_tensor = task[1:]
             if control_tensor is not None:
                 # edit dataset
                 results = self.call_vae_fn(tensor, control_tensor)
             else:
                 results = self.call_vae_fn(tensor)
         elif id > 0:
-            caption, is_video, control_file, pipe = task[1:]
+            caption, is_video, control_file = task[1:]
             args = [caption, is_video]
             idx = id - 1
             if self.te_fn_requires_control_file[idx]:
@@ -1237,7 +2066,7 @@ class DatasetManager:
                 cpu_results[k] = [x.to('cpu') for x in v]
             else:
                 cpu_results[k] = v.to('cpu')
-        pipe.send(cpu_results)
+        return cpu_results
 
 
 def split_batch(batch, pieces):
@@ -1266,11 +2095,21 @@ def split_batch(batch, pieces):
 #     return examples
 
 
+def _pin_memory(tensors):
+    return tuple(tensor.pin_memory() if isinstance(tensor, torch.Tensor) else tensor for tensor in tensors)
+
+
+# Marks the end of the batches put on a prefetch queue.
+_END_OF_BATCHES = object()
+
+
 # DataLoader that divides batches into microbatches for gradient accumulation steps when doing
 # pipeline parallel training. Iterates indefinitely (deepspeed requirement). Keeps track of epoch.
 # Updates epoch as soon as the final batch is returned (notably different from qlora-pipe).
+# With prefetch_depth > 0, model.prepare_inputs() runs in a background thread up to that many batches ahead.
+# It still samples from torch's global generator, so the noise it draws then depends on thread timing.
 class PipelineDataLoader:
-    def __init__(self, dataset, model_engine, gradient_accumulation_steps, model, num_dataloader_workers=1):
+    def __init__(self, dataset, model_engine, gradient_accumulation_steps, model, num_dataloader_workers=1, prefetch_depth=0, pin_memory=False):
         if len(dataset) == 0:
             raise RuntimeError(
                 'Processed dataset was empty. Probably caused by rounding down for each size bucket.\n'
@@ -1282,20 +2121,31 @@ class PipelineDataLoader:
         self.model_engine = model_engine
         self.gradient_accumulation_steps = gradient_accumulation_steps
         self.num_dataloader_workers = num_dataloader_workers
+        self.prefetch_depth = prefetch_depth
+        # Prepared inputs are pinned so they're copied to the GPU faster.
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # Seconds spent waiting for the next prepared batch, and preparing batches, since the last pop_timings().
+        self.wait_time = 0.0
+        self.prepare_time = 0.0
+        self.num_timed_batches = 0
         self.iter_called = False
         self.eval_quantile = None
         self.epoch = 1
         self.num_batches_pulled = 0
         self.next_micro_batch = None
-        self.recreate_dataloader = False
         # Be careful to only create the DataLoader some bounded number of times: https://github.com/pytorch/pytorch/issues/91252
+        # It's created once. Resuming from a checkpoint only sets where the sampler starts.
+        self.sampler = ResumableSampler(len(self.dataset))
         self._create_dataloader()
         self.data = self._pull_batches_from_dataloader()
 
     def reset(self):
         self.epoch = 1
         self.num_batches_pulled = 0
+        self.sampler.start = 0
         self.next_micro_batch = None
+        # stops the prefetch thread, if there is one
+        self.data.close()
         self.data = self._pull_batches_from_dataloader()
 
     def set_eval_quantile(self, quantile):
@@ -1315,42 +2165,108 @@ class PipelineDataLoader:
         try:
             self.next_micro_batch = next(self.data)
         except StopIteration:
-            if self.recreate_dataloader:
-                self._create_dataloader()
-                self.recreate_dataloader = False
+            self.sampler.start = 0
             self.data = self._pull_batches_from_dataloader()
             self.num_batches_pulled = 0
             self.next_micro_batch = None
             self.epoch += 1
         return ret
 
-    def _create_dataloader(self, skip_first_n_batches=None):
-        if skip_first_n_batches is not None:
-            sampler = SkipFirstNSampler(skip_first_n_batches, len(self.dataset))
-        else:
-            sampler = None
+    def _create_dataloader(self):
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             pin_memory=False,
             batch_size=None,
-            sampler=sampler,
+            sampler=self.sampler,
             num_workers=self.num_dataloader_workers,
             persistent_workers=(self.num_dataloader_workers > 0),
             prefetch_factor=2 if self.num_dataloader_workers > 0 else None,
         )
 
     def _pull_batches_from_dataloader(self):
+        batches = self._prefetch_prepared_batches() if self.prefetch_depth > 0 else self._prepare_batches()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    features, label = next(batches)
+                except StopIteration:
+                    return
+                self.wait_time += time.perf_counter() - start
+                self.num_timed_batches += 1
+                target, mask = label
+                # The target depends on the noise, so we must broadcast it from the first stage to the last.
+                # NOTE: I had to patch the pipeline parallel TrainSchedule so that the LoadMicroBatch commands
+                # would line up on the first and last stage so that this doesn't deadlock.
+                # This stays on the main thread so the communication happens in the order the schedule expects.
+                target = self._broadcast_target(target)
+                label = (target, mask)
+                self.num_batches_pulled += 1
+                for micro_batch in split_batch((features, label), self.gradient_accumulation_steps):
+                    yield micro_batch
+        finally:
+            batches.close()
+
+    def _prepare_batches(self):
         for batch in self.dataloader:
+            start = time.perf_counter()
             features, label = self.model.prepare_inputs(batch, timestep_quantile=self.eval_quantile)
-            target, mask = label
-            # The target depends on the noise, so we must broadcast it from the first stage to the last.
-            # NOTE: I had to patch the pipeline parallel TrainSchedule so that the LoadMicroBatch commands
-            # would line up on the first and last stage so that this doesn't deadlock.
-            target = self._broadcast_target(target)
-            label = (target, mask)
-            self.num_batches_pulled += 1
-            for micro_batch in split_batch((features, label), self.gradient_accumulation_steps):
-                yield micro_batch
+            if self.pin_memory:
+                features, label = _pin_memory(features), _pin_memory(label)
+            self.prepare_time += time.perf_counter() - start
+            yield features, label
+
+    def _prefetch_prepared_batches(self):
+        prepared = queue.Queue(maxsize=self.prefetch_depth)
+        stop = threading.Event()
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+
+        def put(item):
+            # Gives up if the consumer went away, instead of blocking forever on a full queue.
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prefetch():
+            if device is not None:
+                # the current device is per thread
+                torch.cuda.set_device(device)
+            try:
+                for item in self._prepare_batches():
+                    if not put(item):
+                        return
+                put(_END_OF_BATCHES)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=prefetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = prepared.get()
+                if item is _END_OF_BATCHES:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def pop_timings(self):
+        '''Returns the average seconds per batch spent waiting for the next prepared batch, and preparing batches,
+        since the last call. If waiting is close to preparing (or to the step time), data loading is the bottleneck.'''
+        if self.num_timed_batches == 0:
+            return 0.0, 0.0
+        timings = (self.wait_time / self.num_timed_batches, self.prepare_time / self.num_timed_batches)
+        self.wait_time = 0.0
+        self.prepare_time = 0.0
+        self.num_timed_batches = 0
+        return timings
 
     def _broadcast_target(self, target):
         model_engine = self.model_engine
@@ -1394,27 +2310,29 @@ class PipelineDataLoader:
         assert not self.iter_called
         self.epoch = state_dict['epoch']
         # -1 because by preloading the next micro_batch, it's always going to have one more batch
-        # pulled than the actual number of batches iterated by the caller.
-        self.num_batches_pulled = state_dict['num_batches_pulled'] - 1
-        self._create_dataloader(skip_first_n_batches=self.num_batches_pulled)
+        # pulled than the actual number of batches iterated by the caller. Except at the end of an
+        # epoch, where nothing of the next epoch has been pulled yet.
+        self.num_batches_pulled = max(state_dict['num_batches_pulled'] - 1, 0)
+        # The rest of this epoch starts here. The sampler is set back to the beginning when the epoch ends.
+        self.sampler.start = self.num_batches_pulled
+        self.data.close()
         self.data = self._pull_batches_from_dataloader()
-        # Recreate the dataloader after the first pass so that it won't skip
-        # batches again (we only want it to skip batches the first time).
-        self.recreate_dataloader = True
 
 
-class SkipFirstNSampler(torch.utils.data.Sampler):
-    def __init__(self, n, dataset_length):
+# Iterates over the dataset in order, starting at index start. Setting start lets a DataLoader resume
+# partway through an epoch without creating a separate DataLoader to skip batches.
+# The DataLoader iterator may call iter() more than once per pass, so this must not change any state.
+class ResumableSampler(torch.utils.data.Sampler):
+    def __init__(self, dataset_length):
         super().__init__()
-        self.n = n
         self.dataset_length = dataset_length
+        self.start = 0
 
     def __len__(self):
-        return self.dataset_length
+        return self.dataset_length - self.start
 
     def __iter__(self):
-        for i in range(self.n, self.dataset_length):
-            yield i
+        return iter(range(self.start, self.dataset_length))
 
 
 if __name__ == '__main__':